@@ -1,48 +1,94 @@
 import numpy as np
-import pandas as pd
 from datetime import datetime
-from intervaltree import Interval, IntervalTree
-from common import operators
-from generate_operators_availability import generate_lab_hours
+from assignments_log import AssignmentRecorder
+from operators_calendar import OperatorsCalendar
+from operators_index import OperatorsIndex
 
-operators_dict: dict = {operator.name: operator for operator in operators} 
 
-def assign_operators(time, operators_available, task, operators_assignments) -> None:
-    if operators_assignments.shape[0] > 0:   # Check if there are any lines in operators_assignments
-        last_assignment: pd.DataFrame = operators_assignments.tail(1)
-        last_assignment_date: datetime = last_assignment.index[0]
-        last_assignment_operators: tuple = last_assignment.dropna(axis=1).iloc[0].iloc[0]
+# The operator is not available for other tasks during the time required by this one
+def reserve_operator(operator, time, task, operators_index: OperatorsIndex) -> None:
+    operators_index.reserve(operators_index.operator_indices[operator.name], time, time + task.required)
+
+
+def assign_operators(time, operators_available, task, operators_assignments: AssignmentRecorder,
+                     operators_calendar: OperatorsCalendar, operators_index: OperatorsIndex, rng=np.random) -> None:
+    operators_dict: dict = {operator.name: operator for operator in operators_available}
+    last_assignment = operators_assignments.last()
+
+    if last_assignment is not None:   # Check if there are any past assignments
+        last_assignment_date: datetime = last_assignment[0]
+        last_assignment_operators: tuple = last_assignment[1]
 
         # Two things need to be checked:
         # 1. Has the last assignment been done in the same half-day
         # 2. Are the two past assigned operators still available
 
-        todays_lab_hours: IntervalTree = generate_lab_hours(time)    # TODO: this is highly inefficient to compute the lab hours twice in the same main loop in ProductionSimulation.py. This call is normally not necessary since it's been already called once in the loop
-
-        same_period: bool = (todays_lab_hours[last_assignment_date] == todays_lab_hours[time])
-        operators_still_available: bool = (set(last_assignment_operators) <= set([operator.name for operator in operators_available]))
+        same_period: bool = (operators_calendar.lab_periods_containing(last_assignment_date) == operators_calendar.lab_periods_containing(time))
+        operators_still_available: bool = (set(last_assignment_operators) <= set(operators_dict))
 
         if same_period and operators_still_available:
             first_operator, second_operator = chosen_operators = (operators_dict[last_assignment_operators[0]], operators_dict[last_assignment_operators[1]])
-            first_operator.availability.chop(time, time + task.required)
-            second_operator.availability.chop(time, time + task.required)
+            reserve_operator(first_operator, time, task, operators_index)
+            reserve_operator(second_operator, time, task, operators_index)
             assigned_operators = (first_operator.name, second_operator.name)
-            operators_assignments.loc[time, task.name] = assigned_operators
+            operators_assignments.append(time, time + task.required, task.name, *assigned_operators)
         
         else:
             # If we can't reassign the past operators, we choose two new operators at random
-            chosen_operators: list = np.random.choice(operators_available, 2, replace=False)
+            chosen_operators: list = rng.choice(operators_available, 2, replace=False)
             first_operator, second_operator = chosen_operators
-            first_operator.availability.chop(time, time + task.required)
-            second_operator.availability.chop(time, time + task.required)
+            reserve_operator(first_operator, time, task, operators_index)
+            reserve_operator(second_operator, time, task, operators_index)
             assigned_operators = (first_operator.name, second_operator.name)
-            operators_assignments.loc[time, task.name] = assigned_operators
+            operators_assignments.append(time, time + task.required, task.name, *assigned_operators)
         
     else:
         # If we can't reassign the past operators, we choose two new operators at random
-        chosen_operators: list = np.random.choice(operators_available, 2, replace=False)
+        chosen_operators: list = rng.choice(operators_available, 2, replace=False)
         first_operator, second_operator = chosen_operators
-        first_operator.availability.chop(time, time + task.required)
-        second_operator.availability.chop(time, time + task.required)
+        reserve_operator(first_operator, time, task, operators_index)
+        reserve_operator(second_operator, time, task, operators_index)
         assigned_operators = (first_operator.name, second_operator.name)
-        operators_assignments.loc[time, task.name] = assigned_operators
+        operators_assignments.append(time, time + task.required, task.name, *assigned_operators)
+
+
+# Batch version of assign_operators: all the tasks due at the same decision point are paired at once, in their order of
+# priority (greedy matching). The availability of every operator for every step is computed in one pass, then each task
+# takes, among the qualified operators still free at that time:
+#   - a pair assigned together at the last assignment time, if it was in the same half-day (the preference of
+#     assign_operators to keep the same pair within a half-day),
+#   - otherwise two operators chosen at random.
+# The tasks run in parallel from the given time. Returns for each task whether it got a pair, the others have to wait.
+def assign_operators_batch(time, tasks: list, operators_assignments: AssignmentRecorder,
+                           operators_calendar: OperatorsCalendar, operators_index: OperatorsIndex,
+                           rng=np.random) -> list:
+    steps = list({task.name: task for task in tasks}.values())
+    step_rows: dict = {step.name: row for row, step in enumerate(steps)}
+    available: np.ndarray = operators_index.available_by_step(steps, time)
+
+    preferred_pairs: list = []
+    last_assignments = operators_assignments.last_pairs()
+    if last_assignments is not None:
+        last_assignment_date, last_pairs = last_assignments
+        if operators_calendar.lab_periods_containing(last_assignment_date) == operators_calendar.lab_periods_containing(time):
+            preferred_pairs = [(operators_index.operator_indices[first], operators_index.operator_indices[second])
+                               for first, second in last_pairs]
+
+    free: np.ndarray = np.ones(len(operators_index.operator_names), dtype=bool)
+    assigned: list = []
+    for task in tasks:
+        candidates = available[step_rows[task.name]] & free
+        pair = next((pair for pair in preferred_pairs if candidates[pair[0]] and candidates[pair[1]]), None)
+        if pair is None:
+            if candidates.sum() < 2:
+                assigned.append(False)
+                continue
+            pair = tuple(int(operator_index) for operator_index in rng.choice(np.flatnonzero(candidates), 2, replace=False))
+
+        free[list(pair)] = False
+        for operator_index in pair:
+            operators_index.reserve(operator_index, time, time + task.required)
+        operators_assignments.append(time, time + task.required, task.name,
+                                     operators_index.operator_names[pair[0]], operators_index.operator_names[pair[1]])
+        assigned.append(True)
+    return assigned
@@ -1,90 +1,150 @@
-from datetime import timedelta
+import heapq
+from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
 
-from common import *
-
-# Load the state of production csv data into each step
-state_of_production = pd.read_csv("inventory.csv", sep=";", dtype={"Quantity": 'Int64'}, index_col=0,
-                                  parse_dates=["Launching Time"])
-state_of_production.fillna({"Quantity": 0}, inplace=True)
-
-total_modules_number: int = int(sum(state_of_production.loc[:, "Quantity"]))
-# for delivery in modules_planned_deliveries:
-#    total_modules_number += modules_planned_deliveries[delivery]
-
-# This piece of code fills by default the missing values of the Ready components launching time
-# to simulation_start_time - duration of the task to simulate the fact that they are just ready to
-# be moved to the next step when the simulation is launched.
-for index, row in state_of_production.iterrows():  # I prefer to work with literal values of Index and Columns rather than the integer values for more reliability and legibility
-    if row["Quantity"] > 0:  # We only care about the Steps where there are modules
-        for task in iter(Chronologically_Ordered_Steps):
-            if task in index:  # Looks for the task associated with the row TODO : suppress this loop by implementing yet another lookup table
-                if pd.isna(state_of_production.loc[index, "Launching Time"]):
-                    Time_ready_by_simulation_start = simulation_start - Chronologically_Ordered_Steps[
-                        task].duration  # In the last part we extract the duration associated with the task
-                    state_of_production.loc[index, "Launching Time"] = Time_ready_by_simulation_start
-
-# Now we fill all those initial data into the log attribute of each step
-for Step in Chronologically_Ordered_Steps.values():
-    row_Ready = state_of_production.loc[Step.name + " Ready"]
-    row_WIP = state_of_production.loc[Step.name + " WIP"]
-    df_Ready = pd.DataFrame([[row_Ready.loc["Launching Time"], pd.NaT] for _ in range(row_Ready.loc["Quantity"])],
-                            columns=["Entry_Date", "Exit_Date"])
-    df_WIP = pd.DataFrame([[row_WIP.loc["Launching Time"], pd.NaT] for _ in range(row_WIP.loc["Quantity"])],
-                          columns=["Entry_Date", "Exit_Date"])
-    Step.log = pd.concat([Step.log, df_Ready, df_WIP],
-                         ignore_index=True)  # TODO : maybe numpy arrays are better suited in this context, since it's a single type of datatype, in addition to that this line raises a warning
-
-
-def tasks_by_priority(time: timedelta) -> list:  # Returns the list of tasks that can be done at the current time
+from step_log import to_ns
 
-    steps_to_do = []
 
-    for step in list(reversed(Chronologically_Ordered_Steps.values())):
+# Load the state of production csv data
+def load_inventory(path: str = "inventory.csv") -> pd.DataFrame:
+    state_of_production = pd.read_csv(path, sep=";", dtype={"Quantity": 'Int64'}, index_col=0,
+                                      parse_dates=["Launching Time"])
+    state_of_production.fillna({"Quantity": 0}, inplace=True)
+    return state_of_production
 
-        # First step, check if the step is ready to process new modules
-        time_array: np.ndarray = np.full_like(step.log.loc[:, "Entry_Date"], time)
-        time_spent_in_task: pd.DataFrame = time_array - step.log.loc[:, "Entry_Date"]
 
-        # We check if the number of modules being processed at the moment is greater than the capacity of the step
+def total_modules_number(state_of_production: pd.DataFrame) -> int:
+    return int(sum(state_of_production.loc[:, "Quantity"]))
 
-        condition = sum((time_spent_in_task < step.duration) & (pd.isna(step.log["Exit_Date"]))) >= step.capacity
 
-        if condition:  # If the step is not ready to process new modules
-            continue  # we break the loop and go to the next step
+# Fills the log attribute of each step with the state of production
+def fill_initial_inventory(Chronologically_Ordered_Steps: dict, state_of_production: pd.DataFrame,
+                           simulation_start: datetime) -> None:
+    state_of_production = state_of_production.copy()
 
-        if step.previous_steps[
-            0] is None:  # If previous_steps is None. That means that this the first step
-            continue  # By default the first step is always ready, in fact that means that there are not enough components left
+    # This piece of code fills by default the missing values of the Ready components launching time
+    # to simulation_start_time - duration of the task to simulate the fact that they are just ready to
+    # be moved to the next step when the simulation is launched.
+    for index, row in state_of_production.iterrows():  # I prefer to work with literal values of Index and Columns rather than the integer values for more reliability and legibility
+        if row["Quantity"] > 0:  # We only care about the Steps where there are modules
+            for task in iter(Chronologically_Ordered_Steps):
+                if task in index:  # Looks for the task associated with the row TODO : suppress this loop by implementing yet another lookup table
+                    if pd.isna(state_of_production.loc[index, "Launching Time"]):
+                        Time_ready_by_simulation_start = simulation_start - Chronologically_Ordered_Steps[
+                            task].duration  # In the last part we extract the duration associated with the task
+                        state_of_production.loc[index, "Launching Time"] = Time_ready_by_simulation_start
 
-        else:
-            # Second step, we compute the reception capacity of the step
-            reception_capacity = step.capacity - sum(pd.isna(
-                step.log["Exit_Date"]))  # We compute the number of modules ready to be processed in the next step
+    # Now we fill all those initial data into the log attribute of each step, the Ready modules first, then the WIP ones
+    for Step in Chronologically_Ordered_Steps.values():
+        row_Ready = state_of_production.loc[Step.name + " Ready"]
+        row_WIP = state_of_production.loc[Step.name + " WIP"]
+        for row in (row_Ready, row_WIP):
+            for _ in range(row.loc["Quantity"]):
+                Step.log.add(row.loc["Launching Time"])
 
-            # Now we check if among the previous steps there are enough modules ready to be processed in the next step
-            ready_to_be_processed: bool = True
-            modules_ready_overall: int = np.inf
-            for previous_step in step.previous_steps:
 
-                previous_time_array: np.ndarray = np.full_like(previous_step.log.loc[:, "Entry_Date"], time)
-                time_spent_in_previous_task: pd.DataFrame = previous_time_array - previous_step.log.loc[:,
-                                                                                  "Entry_Date"]  # Displays the time spent in the previous task for each module
-                modules_ready: int = sum((time_spent_in_previous_task >= previous_step.duration) & (pd.isna(
-                    previous_step.log[
-                        "Exit_Date"])))  # If there are not enough modules ready to be processed in the previous steps
-                modules_ready_overall = min(modules_ready,
-                                            modules_ready_overall)  # We take the minimum of the modules ready in the previous steps
-                if modules_ready <= 0:
-                    ready_to_be_processed = False
-
-            if ready_to_be_processed:
-                for _ in range(
-                        min(reception_capacity, modules_ready_overall)):  # TODO: list comprehension to fasten the loop
-                    steps_to_do.append(step)
+# Number of modules the step can take at the given time: as many as there are free places in the step and modules
+# ready in each of its previous steps, none if the step is full or is a first step
+def step_tasks_count(step, time) -> int:
+    # First step, check if the step is ready to process new modules
+    # We check if the number of modules being processed at the moment is greater than the capacity of the step
+    condition = step.log.in_progress(time) >= step.capacity
+
+    if condition:  # If the step is not ready to process new modules
+        return 0
+
+    if step.previous_steps[
+        0] is None:  # If previous_steps is None. That means that this the first step
+        return 0  # By default the first step is always ready, in fact that means that there are not enough components left
+
+    # Second step, we compute the reception capacity of the step
+    reception_capacity = step.capacity - step.log.open_count  # We compute the number of modules ready to be processed in the next step
+
+    # Now we check if among the previous steps there are enough modules ready to be processed in the next step
+    modules_ready_overall: int = np.inf
+    for previous_step in step.previous_steps:
+
+        modules_ready: int = previous_step.log.ready(time)  # If there are not enough modules ready to be processed in the previous steps
+        modules_ready_overall = min(modules_ready,
+                                    modules_ready_overall)  # We take the minimum of the modules ready in the previous steps
+        if modules_ready <= 0:
+            return 0
+
+    return max(min(reception_capacity, modules_ready_overall), 0)
+
+
+def tasks_by_priority(time: timedelta, Chronologically_Ordered_Steps: dict) -> list:  # Returns the list of tasks that can be done at the current time
+
+    steps_to_do = []
+
+    for step in list(reversed(Chronologically_Ordered_Steps.values())):
+        steps_to_do.extend([step] * step_tasks_count(step, time))
 
     return steps_to_do
-        
-        
\ No newline at end of file
+
+
+# Incremental version of tasks_by_priority. The number of tasks of a step only depends on its log and on the logs of its
+# previous steps, so it is only computed again for the "dirty" steps:
+#   - the steps whose log changed (a module moved in or out, a component delivered) and the steps right after them,
+#   - the steps where a module finished its duration, and the steps right after them. The dates at which the modules
+#     finish are kept in a heap, popped as the clock moves forward.
+# The steps that have tasks are kept in a set, so that a query costs O(changed steps) instead of O(all steps).
+# The clock only moves forward: a query in the past falls back to tasks_by_priority.
+class ReadinessTracker:
+
+    def __init__(self, Chronologically_Ordered_Steps: dict):
+        self.steps_by_name: dict = Chronologically_Ordered_Steps
+        self.steps: list = list(Chronologically_Ordered_Steps.values())
+        self.step_indices: dict = {step.name: index for index, step in enumerate(self.steps)}
+        self.next_steps: list = [[] for _ in self.steps]
+        for index, step in enumerate(self.steps):
+            if step.previous_steps[0] is not None:
+                for previous_step in step.previous_steps:
+                    self.next_steps[self.step_indices[previous_step.name]].append(index)
+
+        self.counts: list = [0] * len(self.steps)
+        self.with_tasks: set = set()
+        self.dirty: set = set(range(len(self.steps)))
+        self.changes: list = []  # Heap of (date in ns at which a module finishes its duration, step index)
+        for index, step in enumerate(self.steps):
+            for ready_date in step.log.open_ready_dates():
+                self.changes.append((to_ns(ready_date), index))
+        heapq.heapify(self.changes)
+        self.time_ns = None
+
+    def _touch(self, index: int) -> None:
+        self.dirty.add(index)
+        self.dirty.update(self.next_steps[index])
+
+    # A module entered the step at the given time (taken from the previous steps, or delivered for a first step)
+    def entered(self, step, time) -> None:
+        index = self.step_indices[step.name]
+        self._touch(index)
+        if step.previous_steps[0] is not None:
+            for previous_step in step.previous_steps:
+                self._touch(self.step_indices[previous_step.name])
+        heapq.heappush(self.changes, (to_ns(time + step.duration), index))
+
+    # Same list as tasks_by_priority(time, Chronologically_Ordered_Steps)
+    def tasks(self, time) -> list:
+        time_ns = to_ns(time)
+        if self.time_ns is not None and time_ns < self.time_ns:
+            return tasks_by_priority(time, self.steps_by_name)
+        self.time_ns = time_ns
+
+        while self.changes and self.changes[0][0] <= time_ns:
+            self._touch(heapq.heappop(self.changes)[1])
+        for index in self.dirty:
+            self.counts[index] = step_tasks_count(self.steps[index], time)
+            if self.counts[index]:
+                self.with_tasks.add(index)
+            else:
+                self.with_tasks.discard(index)
+        self.dirty.clear()
+
+        steps_to_do = []
+        for index in sorted(self.with_tasks, reverse=True):
+            steps_to_do.extend([self.steps[index]] * self.counts[index])
+        return steps_to_do
@@ -0,0 +1,241 @@
+import ast
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+try:  # The Parquet export is optional, the CSV one only needs pandas
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Append-only record of the assignments of the operators, one record (time, end, step, operator_a, operator_b) per
+# task. The names of the steps and operators are dictionary encoded (stored as small integer codes), the records are
+# buffered in a fixed size numpy chunk and, when a path is given, flushed chunk by chunk to a long format file as the
+# simulation runs, so that the memory stays flat on multi-year runs:
+#   - a CSV file ("*.csv"), with the names of the steps and operators,
+#   - a Parquet dataset (any other path, a directory with one file per chunk), with dictionary encoded columns.
+# Without path the full chunks are kept in memory.
+# The legacy wide view (one column per step, one row per time, tuples of names in the cells) is rebuilt on demand.
+
+RECORD_DTYPE: np.dtype = np.dtype([("time", "datetime64[ns]"), ("end", "datetime64[ns]"), ("step", np.int16),
+                                   ("operator_a", np.int16), ("operator_b", np.int16)])
+COLUMNS: list = list(RECORD_DTYPE.names)
+
+
+def is_csv(path: str) -> bool:
+    return path.endswith(".csv")
+
+
+class AssignmentRecorder:
+
+    def __init__(self, step_names: list, operator_names: list, path=None, chunk_size: int = 4096):
+        self.step_names: list = list(step_names)
+        self.operator_names: list = list(operator_names)
+        self._step_codes: dict = {name: code for code, name in enumerate(self.step_names)}
+        self._operator_codes: dict = {name: code for code, name in enumerate(self.operator_names)}
+
+        self.path = path
+        self._chunk: np.ndarray = np.empty(chunk_size, dtype=RECORD_DTYPE)
+        self._chunk_length: int = 0
+        self._chunks: list = []  # Full chunks kept in memory when there is no path
+        self._flushed: int = 0  # Number of records written to the file
+        self._parts: list = []  # Index of the first record of each write to the file, and where it starts in the file
+        self._last_time = None  # Latest assignment time, and operators assigned to each step at that time
+        self._last_pairs: dict = {}
+        self.observer = None  # Optional object notified of each assignment (see metrics.ProductionMetrics.assign)
+
+        if path is not None:  # A new recorder starts a new file
+            if is_csv(path):
+                pd.DataFrame(columns=COLUMNS).to_csv(path, index=False)
+            else:
+                if pyarrow is None:
+                    raise ImportError("pyarrow is required to export the assignments to Parquet, use a .csv path instead")
+                os.makedirs(path, exist_ok=True)
+                for part in glob.glob(os.path.join(path, "part-*.parquet")):
+                    os.remove(part)
+
+    def __len__(self) -> int:
+        return self._flushed + sum(len(chunk) for chunk in self._chunks) + self._chunk_length
+
+    def append(self, time, end, step_name: str, operator_a: str, operator_b: str) -> None:
+        if self._chunk_length == len(self._chunk):
+            self.flush()
+        self._chunk[self._chunk_length] = (np.datetime64(time, "ns"), np.datetime64(end, "ns"),
+                                           self._step_codes[step_name], self._operator_codes[operator_a],
+                                           self._operator_codes[operator_b])
+        self._chunk_length += 1
+        if time != self._last_time:
+            self._last_time, self._last_pairs = time, {}
+        self._last_pairs[self._step_codes[step_name]] = (operator_a, operator_b)
+        if self.observer is not None:
+            self.observer.assign(time, end, operator_a, operator_b)
+
+    # Appends already encoded records (e.g. restored from a checkpoint)
+    def extend(self, records: np.ndarray) -> None:
+        if len(records) == 0:
+            return
+        self.flush()
+        self._write(np.array(records, dtype=RECORD_DTYPE))
+        last_time = records["time"][-1]
+        self._last_time = pd.Timestamp(last_time).to_pydatetime()
+        self._last_pairs = {int(record["step"]): (self.operator_names[record["operator_a"]],
+                                                  self.operator_names[record["operator_b"]])
+                            for record in records[records["time"] == last_time]}
+
+    # Time and operators of the last assignment, None if nothing was assigned yet. Like the last row of the legacy wide
+    # frame, when several steps were assigned at the last time the first of them (in the order of the steps) is taken.
+    def last(self):
+        if self._last_time is None:
+            return None
+        return self._last_time, self._last_pairs[min(self._last_pairs)]
+
+    # Time of the last assignments and operators of all the steps assigned at that time (in the order of the steps),
+    # None if nothing was assigned yet
+    def last_pairs(self):
+        if self._last_time is None:
+            return None
+        return self._last_time, [self._last_pairs[code] for code in sorted(self._last_pairs)]
+
+    # Writes the buffered records to the file (or keeps them in memory if there is no file)
+    def flush(self) -> None:
+        if self._chunk_length == 0:
+            return
+        records = self._chunk[:self._chunk_length].copy()
+        self._chunk_length = 0
+        self._write(records)
+
+    def _write(self, records: np.ndarray) -> None:
+        if self.path is None:
+            self._chunks.append(records)
+            return
+
+        if is_csv(self.path):
+            self._parts.append((self._flushed, os.path.getsize(self.path)))
+            decode(records, self.step_names, self.operator_names).to_csv(self.path, mode="a", header=False, index=False)
+        else:
+            part = os.path.join(self.path, f"part-{self._flushed:012d}.parquet")
+            self._parts.append((self._flushed, part))
+            pyarrow.parquet.write_table(to_arrow(records, self.step_names, self.operator_names), part)
+        self._flushed += len(records)
+
+    # Records written to the file from the given index on, only the writes containing them are read back
+    def _read_since(self, start: int) -> np.ndarray:
+        part_index = max(index for index, (first, _) in enumerate(self._parts) if first <= start)
+        first, location = self._parts[part_index]
+        if is_csv(self.path):
+            with open(self.path, "r") as file:
+                file.seek(location)
+                assignments = pd.read_csv(file, header=None, names=COLUMNS, parse_dates=["time", "end"])
+        else:
+            assignments = pyarrow.concat_tables([pyarrow.parquet.read_table(part) for _, part in self._parts[part_index:]],
+                                                promote_options="permissive").to_pandas()
+        return encode(assignments, self.step_names, self.operator_names)[start - first:]
+
+    # Records from the given index on (e.g. the ones added since the last checkpoint), in the order of the assignments
+    def records_since(self, start: int) -> np.ndarray:
+        parts = []
+        if self.path is not None and start < self._flushed:
+            parts.append(self._read_since(start))
+        in_memory = np.concatenate(self._chunks + [self._chunk[:self._chunk_length]])
+        parts.append(in_memory[max(start - self._flushed, 0):])
+        return np.concatenate(parts)
+
+    # All the records, in the order of the assignments
+    def records(self) -> np.ndarray:
+        return self.records_since(0)
+
+    # Long format view, with categorical names
+    def to_frame(self) -> pd.DataFrame:
+        return decode(self.records(), self.step_names, self.operator_names)
+
+    # Legacy wide view
+    def to_wide(self) -> pd.DataFrame:
+        return to_wide(self.to_frame(), self.step_names)
+
+
+# Records -> long format DataFrame, the codes being replaced by categorical names
+def decode(records: np.ndarray, step_names: list, operator_names: list) -> pd.DataFrame:
+    return pd.DataFrame({
+        "time": records["time"],
+        "end": records["end"],
+        "step": pd.Categorical.from_codes(records["step"], categories=step_names),
+        "operator_a": pd.Categorical.from_codes(records["operator_a"], categories=operator_names),
+        "operator_b": pd.Categorical.from_codes(records["operator_b"], categories=operator_names),
+    })
+
+
+# Long format DataFrame -> records, with the codes of the given names
+def encode(assignments: pd.DataFrame, step_names: list, operator_names: list) -> np.ndarray:
+    records = np.empty(len(assignments), dtype=RECORD_DTYPE)
+    records["time"] = assignments["time"].values
+    records["end"] = assignments["end"].values
+    records["step"] = pd.Categorical(assignments["step"], categories=step_names).codes
+    records["operator_a"] = pd.Categorical(assignments["operator_a"], categories=operator_names).codes
+    records["operator_b"] = pd.Categorical(assignments["operator_b"], categories=operator_names).codes
+    return records
+
+
+def to_arrow(records: np.ndarray, step_names: list, operator_names: list):
+    steps = pyarrow.array(step_names, type=pyarrow.string())
+    operators = pyarrow.array(operator_names, type=pyarrow.string())
+    return pyarrow.table({
+        "time": pyarrow.array(records["time"]),
+        "end": pyarrow.array(records["end"]),
+        "step": pyarrow.DictionaryArray.from_arrays(pyarrow.array(records["step"]), steps),
+        "operator_a": pyarrow.DictionaryArray.from_arrays(pyarrow.array(records["operator_a"]), operators),
+        "operator_b": pyarrow.DictionaryArray.from_arrays(pyarrow.array(records["operator_b"]), operators),
+    })
+
+
+# Loads a long format export (CSV file or Parquet dataset) as a DataFrame with categorical names
+def load_assignments(path: str) -> pd.DataFrame:
+    if is_csv(path):
+        assignments = pd.read_csv(path, parse_dates=["time", "end"],
+                                  dtype={"step": "category", "operator_a": "category", "operator_b": "category"})
+    else:
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to load assignments exported to Parquet")
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        if not parts:
+            return pd.DataFrame(columns=COLUMNS)
+        assignments = pyarrow.concat_tables([pyarrow.parquet.read_table(part) for part in parts],
+                                            promote_options="permissive").to_pandas()
+    return assignments[COLUMNS]
+
+
+# Rebuilds the legacy wide view: one row per assignment time, one column per step, (operator_a, operator_b) in the
+# cells. When two tasks of the same step start at the same time, the last one is kept (as the legacy frame did).
+def to_wide(assignments: pd.DataFrame, step_names=None) -> pd.DataFrame:
+    if step_names is None:
+        step_names = list(assignments["step"].cat.categories) if hasattr(assignments["step"], "cat") \
+            else list(dict.fromkeys(assignments["step"]))
+
+    times = pd.DatetimeIndex(assignments["time"])
+    row_times = times.unique()
+    rows = row_times.get_indexer(times)
+    columns = pd.Index(step_names).get_indexer(assignments["step"])
+
+    values = np.full((len(row_times), len(step_names)), np.nan, dtype=object)
+    for row, column, operator_a, operator_b in zip(rows, columns, assignments["operator_a"], assignments["operator_b"]):
+        values[row, column] = (operator_a, operator_b)
+
+    return pd.DataFrame(values, index=row_times, columns=pd.Index(step_names, dtype=object))
+
+
+# Long format view of a legacy wide frame, the end of each task being its start plus the time required by the step.
+# The cells of a wide frame read back from a CSV file hold stringified tuples.
+def from_wide(operators_assignments: pd.DataFrame, required: dict) -> pd.DataFrame:
+    stacked = operators_assignments.stack(future_stack=True).dropna()
+    times = pd.DatetimeIndex(stacked.index.get_level_values(0))
+    steps = stacked.index.get_level_values(1)
+    pairs = [ast.literal_eval(pair) if isinstance(pair, str) else pair for pair in stacked.values]
+    return pd.DataFrame({
+        "time": times,
+        "end": times + pd.TimedeltaIndex([required[step] for step in steps]),
+        "step": pd.Categorical(steps, categories=list(operators_assignments.columns)),
+        "operator_a": pd.Categorical([pair[0] for pair in pairs]),
+        "operator_b": pd.Categorical([pair[1] for pair in pairs]),
+    })
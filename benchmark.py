@@ -0,0 +1,250 @@
+import argparse
+import copy
+import importlib
+import json
+import os
+import platform
+import subprocess
+import time as clock
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import simulation_engine
+from common import SHIPMENT_STEP, load_config
+from simulation import Simulation
+from TasksHierarchy import load_inventory
+
+# Benchmarks of the simulator on synthetic scenarios. A scenario is derived from the reference inputs
+# (SimulatorInputs.json and inventory.csv) by scaling:
+#   - the number of operators (the new operators copy the skills and work hours of the existing ones),
+#   - the number of steps (the steps are duplicated in place in the StagesAndSteps DAG, the copy of a step coming
+#     right after it),
+#   - the number of modules (put Ready in the first steps),
+#   - the density of the holidays of the operators (share of their working days spent on holiday),
+#   - the length of the horizon.
+# For each scenario the end to end run is timed, as well as the functions of the main loop, and the results are written
+# as JSON so that they can be compared from one version of the code to the other.
+
+# Functions of the event driven loop that are timed, they are looked up in simulation_engine unless their module is
+# given ("module.function"). step_tasks_count is what ReadinessTracker.tasks (inside ready_tasks) calls for the steps
+# whose logs changed.
+TIMED_FUNCTIONS: tuple = ("ready_tasks", "TasksHierarchy.step_tasks_count", "update_log",
+                          "get_next_available_time_for_task", "get_available_operators", "assign_operators")
+
+BASE_SCENARIO: dict = {"operators": 10, "steps": 45, "modules": 40, "holiday_density": None, "horizon_days": 2191}
+
+# Values of each parameter tried by the default suite, the other parameters keeping their base value
+DEFAULT_SUITE: dict = {"operators": [10, 20, 40], "steps": [45, 90], "modules": [10, 40, 80],
+                       "holiday_density": [0.05, 0.2], "horizon_days": [365, 2191]}
+
+
+# Synthetic inputs (configuration and inventory) derived from the reference ones. holiday_density None keeps the
+# holidays of the reference operators.
+def generate_scenario(data: dict, inventory: pd.DataFrame, operators: int = 10, steps: int = 45, modules: int = 40,
+                      holiday_density=None, horizon_days: int = 2191, seed: int = 0) -> tuple:
+    data = copy.deepcopy(data)
+    rng = np.random.default_rng(seed)
+    simulation_start = datetime.fromisoformat(data["SimulationParameters"]["simulation_start"])
+    simulation_end = simulation_start + timedelta(days=horizon_days)
+    data["SimulationParameters"]["simulation_end"] = simulation_end.isoformat()
+    data["SimulationParameters"]["num_modules"] = modules
+
+    # Steps: the copy of a step takes its place in the DAG, right after it
+    base_steps = data["StagesAndSteps"]
+    if steps < len(base_steps):
+        raise ValueError(f"A scenario has at least the {len(base_steps)} steps of the reference inputs, not {steps}")
+    duplicable = [step["Step"] for step in base_steps if step["Previous"][0] != "None" and step["Step"] != SHIPMENT_STEP]
+    copies = {name: 0 for name in duplicable}
+    for index in range(steps - len(base_steps)):
+        copies[duplicable[index % len(duplicable)]] += 1
+
+    renamed = {}  # Name of the last copy of each step, that the following steps now depend on
+    stages_and_steps = []
+    skills_of_copies = {}
+    for step in base_steps:
+        previous = [renamed.get(name, name) for name in step["Previous"]]
+        stages_and_steps.append(dict(step, Previous=previous))
+        last_name = step["Step"]
+        for copy_index in range(copies.get(step["Step"], 0)):
+            name = f"{step['Step']} (copy {copy_index + 1})"
+            stages_and_steps.append(dict(step, Step=name, Previous=[last_name]))
+            skills_of_copies.setdefault(step["Step"], []).append(name)
+            last_name = name
+        renamed[step["Step"]] = last_name
+    data["StagesAndSteps"] = stages_and_steps
+
+    # Operators: the new ones copy the existing ones in turn
+    base_names = list(data["Operators"])
+    names = [f"Operator{index + 1}" for index in range(operators)]
+    base_of = {name: base_names[index % len(base_names)] for index, name in enumerate(names)}
+    base_skills, base_hours, base_holidays = data["Operators"], data["OperatorWorkHours"], data["OperatorHolidays"]
+    data["Operators"] = {name: [skill for base_skill in base_skills[base_of[name]]
+                                for skill in [base_skill] + skills_of_copies.get(base_skill, [])] for name in names}
+    data["OperatorWorkHours"] = {name: base_hours[base_of[name]] for name in names}
+
+    if holiday_density is None:
+        data["OperatorHolidays"] = {name: base_holidays[base_of[name]] for name in names}
+    else:  # Weeks of holidays drawn at random until the density is reached
+        weeks = horizon_days // 7
+        holiday_weeks = int(round(holiday_density * weeks))
+        data["OperatorHolidays"] = {}
+        for name in names:
+            first_days = [simulation_start + timedelta(weeks=int(week))
+                          for week in np.sort(rng.choice(weeks, holiday_weeks, replace=False))]
+            first_days = [day - timedelta(days=day.weekday()) for day in first_days]  # Mondays
+            data["OperatorHolidays"][name] = [[f"{day:%Y-%m-%d}", f"{day + timedelta(days=4):%Y-%m-%d}"]
+                                              for day in first_days]
+
+    # Inventory: the modules are Ready in the first steps, nothing elsewhere
+    rows = []
+    for step in stages_and_steps:
+        first_step = step["Previous"][0] == "None"
+        rows.append((f"{step['Step']} WIP", 0, pd.NaT))
+        rows.append((f"{step['Step']} Ready", modules if first_step else 0, pd.NaT))
+    inventory = pd.DataFrame(rows, columns=["Steps", "Quantity", "Launching Time"]).set_index("Steps")
+    inventory["Quantity"] = inventory["Quantity"].astype("Int64")
+    return data, inventory
+
+
+# Writes the scenario in the SimulatorInputs.json and inventory.csv formats
+def write_scenario(data: dict, inventory: pd.DataFrame, directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "SimulatorInputs.json"), "w") as file:
+        json.dump(data, file, indent=4)
+    inventory.to_csv(os.path.join(directory, "inventory.csv"), sep=";")
+
+
+# Replaces the functions of the main loop with wrappers that count their calls and accumulate their run time
+@contextmanager
+def timed_functions(names: tuple = TIMED_FUNCTIONS):
+    timings = {name: {"calls": 0, "seconds": 0.0} for name in names}
+    modules = {name: importlib.import_module(name.rpartition(".")[0]) if "." in name else simulation_engine
+               for name in names}
+    originals = {name: getattr(modules[name], name.rpartition(".")[2]) for name in names}
+
+    def timed(name, function):
+        def wrapper(*arguments, **keywords):
+            begin = clock.perf_counter()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                timings[name]["seconds"] += clock.perf_counter() - begin
+                timings[name]["calls"] += 1
+        return wrapper
+
+    for name, function in originals.items():
+        setattr(modules[name], name.rpartition(".")[2], timed(name, function))
+    try:
+        yield timings
+    finally:
+        for name, function in originals.items():
+            setattr(modules[name], name.rpartition(".")[2], function)
+
+
+def benchmark_scenario(data: dict, inventory: pd.DataFrame, modules: int, seed: int = 0, repeat: int = 1,
+                       display: bool = True) -> dict:
+    result = {}
+
+    begin = clock.perf_counter()
+    simulation = Simulation(data, inventory, seed)
+    result["build_seconds"] = clock.perf_counter() - begin
+
+    # End to end runs, without the wrappers so that their overhead is not counted
+    run_times = []
+    for _ in range(repeat):
+        simulation.reset(seed)
+        begin = clock.perf_counter()
+        simulation.run(modules)
+        run_times.append(clock.perf_counter() - begin)
+    result["run_seconds"] = min(run_times)
+    result["simulated_days"] = (simulation.time - simulation.simulation_start) / timedelta(days=1)
+    result["modules_completed"] = simulation.modules_completed
+    result["assignments"] = len(simulation.assignments)
+
+    simulation.reset(seed)
+    with timed_functions() as timings:
+        simulation.run(modules)
+    result["functions"] = {name: dict(timing, mean_microseconds=1e6 * timing["seconds"] / timing["calls"]
+                                      if timing["calls"] else None) for name, timing in timings.items()}
+
+    if display:
+        from displays import Display
+        assignments = simulation.assignments.to_frame()
+        begin = clock.perf_counter()
+        Display(assignments, simulation.steps, simulation.operators, show=False)
+        result["display_seconds"] = clock.perf_counter() - begin
+
+    return result
+
+
+# Scenarios of the suite: the base scenario, then each parameter varied alone
+def suite_scenarios(suite: dict, base: dict = BASE_SCENARIO) -> list:
+    scenarios = [dict(base)]
+    for parameter, values in suite.items():
+        scenarios += [dict(base, **{parameter: value}) for value in values if value != base[parameter]]
+    return scenarios
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(data: dict, inventory: pd.DataFrame, scenarios: list, seed: int = 0, repeat: int = 1,
+              display: bool = True, on_result=None) -> dict:
+    results = []
+    for scenario in scenarios:
+        scenario_data, scenario_inventory = generate_scenario(data, inventory, seed=seed, **scenario)
+        result = {"scenario": scenario} | benchmark_scenario(scenario_data, scenario_inventory, scenario["modules"],
+                                                             seed, repeat, display)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+    return {"date": datetime.now().isoformat(timespec="seconds"), "revision": git_revision(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "seed": seed, "repeat": repeat, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the production simulation on synthetic scenarios")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Number of end to end runs per scenario, the best is kept")
+    parser.add_argument("--no-display", action="store_true", help="Do not time the Gantt chart")
+    parser.add_argument("--write-scenarios", default=None,
+                        help="Directory where the inputs of each scenario are written, one subdirectory per scenario")
+    for parameter, values in DEFAULT_SUITE.items():
+        kind = float if parameter == "holiday_density" else int
+        parser.add_argument(f"--{parameter.replace('_', '-')}", type=kind, nargs="+", default=values)
+    arguments = parser.parse_args()
+
+    suite = {parameter: getattr(arguments, parameter) for parameter in DEFAULT_SUITE}
+    scenarios = suite_scenarios(suite)
+    data, inventory = load_config(arguments.config), load_inventory(arguments.inventory)
+
+    if arguments.write_scenarios is not None:
+        for index, scenario in enumerate(scenarios):
+            write_scenario(*generate_scenario(data, inventory, seed=arguments.seed, **scenario),
+                           os.path.join(arguments.write_scenarios, f"scenario_{index}"))
+
+    def print_result(result: dict) -> None:
+        functions = ", ".join(f"{name} {timing['seconds']:.2f}s" for name, timing in result["functions"].items())
+        print(f"{result['scenario']}: run {result['run_seconds']:.2f}s ({result['modules_completed']} modules, "
+              f"{result['assignments']} assignments) | {functions}")
+
+    results = run_suite(data, inventory, scenarios, arguments.seed, arguments.repeat, not arguments.no_display,
+                        print_result)
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2, default=str)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
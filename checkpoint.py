@@ -0,0 +1,303 @@
+import io
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from assignments_log import RECORD_DTYPE, AssignmentRecorder
+from common import build_steps, simulation_period
+from compiled_scenario import inputs_hash, inventory_to_csv
+from simulation import Simulation
+from operators_index import SECOND_NS
+from simulation_engine import EventQueue
+from step_log import StepLog
+from TasksHierarchy import ReadinessTracker, fill_initial_inventory, load_inventory
+
+# Checkpoints of the state of a simulation at a given simulated time: step logs, reservations of the operators,
+# assignments, state of the random generator, events and clock. They are saved as compressed npz archives, the names
+# of the steps and operators being stored once and referred to by their index.
+#
+# A CheckpointStore keeps the checkpoints of a run together with the inputs they were computed from. When the inputs
+# change (a new holiday, a new delivery...), resume() reloads the latest checkpoint taken before the first changed
+# input and only simulates the rest of the horizon. The checkpoints of a store do not hold the assignments: they are
+# appended once to an assignments file of the store, and each checkpoint keeps the number of records it covers.
+
+CHECKPOINT_FORMAT: int = 2
+ASSIGNMENTS_FILE: str = "assignments.bin"  # Raw RECORD_DTYPE records
+
+# Configuration entries whose changes only affect the simulation from the dates they contain, any other change
+# affects the whole simulation
+DATED_ENTRIES: set = {"CERNHolidays", "OperatorHolidays", "ComponentArrivalTimes", "SimulationParameters"}
+
+
+# Without assignments_count, the checkpoint holds all the assignments. With it, they are expected in the assignments
+# file next to the checkpoint (see CheckpointStore).
+def save_checkpoint(simulation: Simulation, path: str, assignments_count=None) -> None:
+    step_names = list(simulation.steps.keys())
+    operator_names = simulation.operators_index.operator_names
+    arrays = {}
+
+    for step_index, step in enumerate(simulation.steps.values()):
+        arrays[f"entry_dates_{step_index}"] = step.log.entry_dates
+        arrays[f"exit_dates_{step_index}"] = step.log.exit_dates
+    arrays["log_clocks"] = np.array([step.log.clock for step in simulation.steps.values()], dtype=np.int64)
+
+    busy_begins, busy_ends = simulation.operators_index.busy_begins, simulation.operators_index.busy_ends
+    arrays["busy_operators"] = np.repeat(np.arange(len(operator_names)), [len(begins) for begins in busy_begins])
+    arrays["busy_begins"] = np.array([begin for begins in busy_begins for begin in begins], dtype=np.int64)
+    arrays["busy_ends"] = np.array([end for ends in busy_ends for end in ends], dtype=np.int64)
+
+    if assignments_count is None:
+        arrays["assignments"] = simulation.assignments.records()
+
+    events, sequence = simulation.events.state()
+    arrays["event_dates"] = np.array([np.datetime64(event[0], "ns") for event in events], dtype="datetime64[ns]")
+    arrays["event_sequences"] = np.array([event[1] for event in events], dtype=np.int64)
+    arrays["event_kinds"] = np.array([event[2] for event in events], dtype=str)
+    arrays["event_payloads"] = np.array(["" if event[3] is None else event[3] for event in events], dtype=str)
+
+    rng_name, rng_keys, rng_position, rng_has_gauss, rng_cached_gaussian = simulation.rng.get_state()
+    arrays["rng_keys"] = rng_keys
+
+    metadata = {"format": CHECKPOINT_FORMAT, "inputs_hash": inputs_hash(simulation.data, simulation.inventory),
+                "time": str(simulation.time), "modules_completed": simulation.modules_completed,
+                "event_sequence": sequence, "next_arrival": simulation.next_arrival, "seed": simulation.seed,
+                "steps": step_names, "operators": operator_names, "index_origin": simulation.operators_index.origin,
+                "rng": [rng_name, rng_position, rng_has_gauss, rng_cached_gaussian], "assignments_count": assignments_count,
+                "deliveries": simulation.deliveries}
+    arrays["metadata"] = np.array(json.dumps(metadata))
+
+    with open(path, "wb") as file:
+        np.savez_compressed(file, **arrays)
+
+
+def read_checkpoint_metadata(path: str) -> dict:
+    with np.load(path) as archive:
+        return json.loads(str(archive["metadata"]))
+
+
+# Puts the simulation in the state saved in the checkpoint. The simulation must have the same steps, and at least the
+# operators of the checkpoint (operators can be added, they are matched by name), and take the deliveries into account
+# like the simulation of the checkpoint. Its metrics and history files (if any) are rebuilt from the checkpoint.
+# By default it must also have been built from the same inputs, resume() and the what-if sweeps disable that check once
+# they made sure that the inputs only changed after the time of the checkpoint.
+def load_checkpoint(simulation: Simulation, path: str, check_inputs: bool = True) -> None:
+    operators_index = simulation.operators_index
+    with np.load(path) as archive:
+        metadata = json.loads(str(archive["metadata"]))
+        if metadata["format"] != CHECKPOINT_FORMAT:
+            raise ValueError(f"Checkpoint {path} has format {metadata['format']}, expected {CHECKPOINT_FORMAT}")
+        if metadata["steps"] != list(simulation.steps.keys()):
+            raise ValueError(f"Checkpoint {path} was made with other steps")
+        missing_operators = set(metadata["operators"]) - set(operators_index.operator_names)
+        if missing_operators:
+            raise ValueError(f"Checkpoint {path} has operators missing from the simulation: {sorted(missing_operators)}")
+        if metadata.get("deliveries", False) != simulation.deliveries:
+            raise ValueError(f"Checkpoint {path} was made with deliveries={metadata.get('deliveries', False)}")
+        if check_inputs and metadata["inputs_hash"] != inputs_hash(simulation.data, simulation.inventory):
+            raise ValueError(f"Checkpoint {path} was made from other inputs")
+
+        for step_index, step in enumerate(simulation.steps.values()):
+            step.log = StepLog.restore(step.duration, archive[f"entry_dates_{step_index}"],
+                                       archive[f"exit_dates_{step_index}"], int(archive["log_clocks"][step_index]))
+
+        # The reservations are saved in seconds from the origin of the index, which depends on the calendars
+        operator_codes = np.array([operators_index.operator_indices[name] for name in metadata["operators"]], dtype=np.int64)
+        shift = (metadata.get("index_origin", operators_index.origin) - operators_index.origin) // SECOND_NS
+        operators_index.clear()
+        for operator_index, begin, end in zip(archive["busy_operators"], archive["busy_begins"], archive["busy_ends"]):
+            operators_index.busy_begins[operator_codes[operator_index]].append(int(begin) + shift)
+            operators_index.busy_ends[operator_codes[operator_index]].append(int(end) + shift)
+
+        if metadata.get("assignments_count") is None:
+            records = archive["assignments"].copy()
+        else:
+            records = np.fromfile(os.path.join(os.path.dirname(path), ASSIGNMENTS_FILE), dtype=RECORD_DTYPE,
+                                  count=metadata["assignments_count"])
+        records["operator_a"] = operator_codes[records["operator_a"]]
+        records["operator_b"] = operator_codes[records["operator_b"]]
+        simulation.assignments = AssignmentRecorder(metadata["steps"], operators_index.operator_names,
+                                                    simulation.assignments_path)
+        simulation.assignments.extend(records)
+
+        events = [(pd.Timestamp(date), int(sequence), str(kind), str(payload) or None) for date, sequence, kind, payload in
+                  zip(archive["event_dates"], archive["event_sequences"], archive["event_kinds"], archive["event_payloads"])]
+        simulation.events = EventQueue.restore(events, metadata["event_sequence"])
+
+        rng_name, rng_position, rng_has_gauss, rng_cached_gaussian = metadata["rng"]
+        simulation.rng.set_state((rng_name, archive["rng_keys"], rng_position, rng_has_gauss, rng_cached_gaussian))
+
+    simulation.seed = metadata["seed"]
+    simulation.time = datetime.fromisoformat(metadata["time"])
+    simulation.modules_completed = metadata["modules_completed"]
+    simulation.next_arrival = metadata.get("next_arrival", 0)
+    simulation.attach_history()
+    simulation.readiness = ReadinessTracker(simulation.steps)
+    simulation.rebuild_metrics()
+
+
+# Entry dates of the modules put in each step by the inventory, sorted
+def initial_content(data: dict, inventory: pd.DataFrame) -> list:
+    steps = build_steps(data)
+    fill_initial_inventory(steps, inventory, simulation_period(data)[0])
+    return [np.sort(step.log.entry_dates) for step in steps.values()]
+
+
+def interval_set(intervals: list) -> set:
+    return {tuple(interval) for interval in intervals}
+
+
+# First simulated time from which the two sets of inputs may give different simulations, None if they are the same.
+# Holidays and deliveries only matter from their dates, the end of the simulation from the earliest of the two ends.
+# Any other change (steps, operators, work hours, start of the simulation) affects the whole simulation.
+# The inventory is compared by the modules it puts in the steps, so edits that do not change them (order of the rows,
+# launching time of an empty row, formatting) are not changes. A real change of the initial content does affect the
+# whole simulation: the modules of the inventory occupy their steps from the start (even the ones launched later), and
+# count in the total of the modules. Modules arriving later are planned in ComponentArrivalTimes, which only matters
+# from the dates of the deliveries.
+def inputs_divergence(old_data: dict, old_inventory: pd.DataFrame, new_data: dict, new_inventory: pd.DataFrame):
+    old_start, old_end = simulation_period(old_data)
+    new_start, new_end = simulation_period(new_data)
+    start = min(old_start, new_start)
+
+    if old_start != new_start:
+        return start
+    for key in set(old_data) | set(new_data):
+        if key not in DATED_ENTRIES and old_data.get(key) != new_data.get(key):
+            return start
+    if not old_inventory.equals(new_inventory):
+        old_content, new_content = initial_content(old_data, old_inventory), initial_content(new_data, new_inventory)
+        if any(not np.array_equal(old, new) for old, new in zip(old_content, new_content)):
+            return start
+
+    changes = []
+    if old_end != new_end:
+        changes.append(min(old_end, new_end))
+
+    changed_holidays = interval_set(old_data["CERNHolidays"]) ^ interval_set(new_data["CERNHolidays"])
+    for name in set(old_data["OperatorHolidays"]) | set(new_data["OperatorHolidays"]):
+        changed_holidays |= interval_set(old_data["OperatorHolidays"].get(name, [])) ^ \
+                            interval_set(new_data["OperatorHolidays"].get(name, []))
+    changes += [datetime.fromisoformat(begin) for begin, _ in changed_holidays]
+
+    old_arrivals, new_arrivals = old_data.get("ComponentArrivalTimes", {}), new_data.get("ComponentArrivalTimes", {})
+    for component in set(old_arrivals) | set(new_arrivals):
+        old_deliveries, new_deliveries = old_arrivals.get(component, {}), new_arrivals.get(component, {})
+        changes += [datetime.fromisoformat(date) for date in set(old_deliveries) | set(new_deliveries)
+                    if old_deliveries.get(date) != new_deliveries.get(date)]
+
+    return max(min(changes), start) if changes else None
+
+
+# Directory holding the checkpoints of a run (one npz archive per checkpoint, named after its simulated time) and the
+# inputs of that run
+class CheckpointStore:
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def inputs_path(self) -> str:
+        return os.path.join(self.directory, "inputs.json")
+
+    def write_inputs(self, data: dict, inventory: pd.DataFrame, seed, deliveries: bool = False) -> None:
+        with open(self.inputs_path, "w") as file:
+            json.dump({"config": data, "inventory": inventory_to_csv(inventory), "seed": seed,
+                       "deliveries": deliveries}, file)
+
+    # Inputs (configuration, inventory, seed, deliveries) of the run whose checkpoints are stored, None if there is no
+    # such run
+    def read_inputs(self):
+        if not os.path.exists(self.inputs_path):
+            return None
+        with open(self.inputs_path, "r") as file:
+            inputs = json.load(file)
+        return (inputs["config"], load_inventory(io.StringIO(inputs["inventory"])), inputs["seed"],
+                inputs.get("deliveries", False))
+
+    def checkpoints(self) -> list:
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".npz"))
+        return [(datetime.strptime(name[:-4], "%Y%m%dT%H%M%S"), os.path.join(self.directory, name)) for name in names]
+
+    @property
+    def assignments_path(self) -> str:
+        return os.path.join(self.directory, ASSIGNMENTS_FILE)
+
+    def _assignments_written(self) -> int:
+        if not os.path.exists(self.assignments_path):
+            return 0
+        return os.path.getsize(self.assignments_path) // RECORD_DTYPE.itemsize
+
+    # Only the assignments recorded since the previous checkpoint are written
+    def save(self, simulation: Simulation) -> str:
+        count, written = len(simulation.assignments), self._assignments_written()
+        if written > count:
+            raise ValueError(f"The assignments of {self.directory} are ahead of the simulation, discard its checkpoints first")
+        with open(self.assignments_path, "ab") as file:
+            simulation.assignments.records_since(written).tofile(file)
+
+        path = os.path.join(self.directory, f"{pd.Timestamp(simulation.time):%Y%m%dT%H%M%S}.npz")
+        save_checkpoint(simulation, path, assignments_count=count)
+        return path
+
+    # Path of the latest checkpoint strictly before the given time (the latest of all if time is None)
+    def latest_before(self, time=None):
+        candidates = [path for checkpoint_time, path in self.checkpoints() if time is None or checkpoint_time < time]
+        return candidates[-1] if candidates else None
+
+    # Also cuts the assignments file back to the latest checkpoint kept
+    def discard_after(self, time) -> None:
+        kept = 0
+        for checkpoint_time, path in self.checkpoints():
+            if checkpoint_time > time:
+                os.remove(path)
+            else:
+                kept = read_checkpoint_metadata(path).get("assignments_count") or 0
+        if os.path.exists(self.assignments_path):
+            with open(self.assignments_path, "r+b") as file:
+                file.truncate(kept * RECORD_DTYPE.itemsize)
+
+
+# Runs the simulation from its current state, saving a checkpoint every `every` of simulated time
+def run_with_checkpoints(simulation: Simulation, modules_to_do: int, store: CheckpointStore,
+                         every: timedelta = timedelta(days=7)) -> datetime:
+    store.save(simulation)
+    while not simulation.is_finished(modules_to_do):
+        periods_done: int = (simulation.time - simulation.simulation_start) // every
+        simulation.run(modules_to_do, until=simulation.simulation_start + (periods_done + 1) * every)
+        store.save(simulation)
+    return simulation.time
+
+
+# Simulates the given inputs, reusing the checkpoints of the store: the simulation restarts from the latest checkpoint
+# taken before the first input that changed since the stored run. The store then holds the checkpoints of the new run.
+# The options of the simulation are those of Simulation; a run with deliveries cannot reuse the checkpoints of a run
+# without them (and the other way round), the metrics and the history files are rebuilt from the checkpoint.
+def resume(data: dict, inventory: pd.DataFrame, directory: str, modules_to_do: int, seed=None,
+           every: timedelta = timedelta(days=7), deliveries: bool = False, metrics_resolution=None,
+           history_directory=None) -> Simulation:
+    store = CheckpointStore(directory)
+    stored_inputs = store.read_inputs()
+
+    path = None
+    if stored_inputs is not None:
+        old_data, old_inventory, stored_seed, stored_deliveries = stored_inputs
+        seed = stored_seed if seed is None else seed
+        if seed == stored_seed and deliveries == stored_deliveries:
+            divergence = inputs_divergence(old_data, old_inventory, data, inventory)
+            path = store.latest_before(divergence)
+
+    simulation = Simulation(data, inventory, seed, deliveries=deliveries, metrics_resolution=metrics_resolution,
+                            history_directory=history_directory)
+    if path is not None:
+        load_checkpoint(simulation, path, check_inputs=False)
+        store.discard_after(simulation.time)
+    else:
+        store.discard_after(datetime.min)
+
+    store.write_inputs(data, inventory, seed, deliveries)
+    run_with_checkpoints(simulation, modules_to_do, store, every)
+    return simulation
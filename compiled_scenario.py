@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from common import COMPONENT_STEPS, Operator, Step, build_operators, build_steps, simulation_period
+from operators_calendar import WEEKDAYS, OperatorsCalendar
+from step_log import StepLog
+from TasksHierarchy import fill_initial_inventory, load_inventory
+
+# Compiled scenario: everything a Simulation builds from SimulatorInputs.json and inventory.csv before its first run
+# (step DAG as integer indices, skill matrix, calendars of the operators, initial content of the step logs), validated
+# once and stored as a compressed npz archive named after the hash of the content of the two files. Later runs on the
+# same files load the archive instead of parsing and compiling the inputs again.
+
+COMPILED_FORMAT: int = 2
+CACHE_DIRECTORY: str = ".scenario_cache"
+
+
+def inventory_to_csv(inventory: pd.DataFrame) -> str:
+    return inventory.to_csv(sep=";")
+
+
+# Hash of the parsed inputs
+def inputs_hash(data: dict, inventory: pd.DataFrame) -> str:
+    content = json.dumps(data, sort_keys=True) + inventory_to_csv(inventory)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# Hash of the content of the input files, computed without parsing them
+def files_hash(config_path: str, inventory_path: str) -> str:
+    content = hashlib.sha256()
+    for path in (config_path, inventory_path):
+        with open(path, "rb") as file:
+            content.update(file.read())
+    return content.hexdigest()
+
+
+# Problems of the inputs that would make the simulation fail or silently give wrong results (see Utils.txt). Returns
+# the list of the problems found, empty if the inputs are valid.
+def validate_scenario(data: dict, inventory: pd.DataFrame) -> list:
+    problems = []
+    step_names = [step["Step"] for step in data["StagesAndSteps"]]
+
+    # Step DAG: the previous steps must be defined before the step
+    defined = set()
+    for step in data["StagesAndSteps"]:
+        if step["Previous"][0] != "None":
+            for previous in step["Previous"]:
+                if previous not in defined:
+                    problems.append(f"Step {step['Step']}: previous step {previous} is not defined before it")
+        if step["Capacity"] < 1:
+            problems.append(f"Step {step['Step']}: capacity {step['Capacity']} is lower than 1")
+        defined.add(step["Step"])
+
+    # Inventory: a WIP and a Ready row per step, no more modules in WIP than the capacity of the step
+    for step in data["StagesAndSteps"]:
+        for state in ("WIP", "Ready"):
+            if f"{step['Step']} {state}" not in inventory.index:
+                problems.append(f"Inventory: no row for {step['Step']} {state}")
+        wip_row = f"{step['Step']} WIP"
+        if wip_row in inventory.index and inventory.loc[wip_row, "Quantity"] > step["Capacity"]:
+            problems.append(f"Inventory: {inventory.loc[wip_row, 'Quantity']} modules in WIP at {step['Step']}, "
+                            f"more than its capacity of {step['Capacity']}")
+
+    # Components: as many bare modules as flexes, delivered to known components
+    totals = {}
+    for component, step_name in COMPONENT_STEPS.items():
+        ready_row = f"{step_name} Ready"
+        totals[component] = int(inventory.loc[ready_row, "Quantity"]) if ready_row in inventory.index else 0
+    for component, deliveries in data.get("ComponentArrivalTimes", {}).items():
+        if component not in COMPONENT_STEPS:
+            problems.append(f"ComponentArrivalTimes: unknown component {component}")
+            continue
+        totals[component] += sum(deliveries.values())
+    if len(set(totals.values())) > 1:
+        problems.append(f"Components: the numbers of bare modules and flexes differ ({totals})")
+
+    # Operators: work hours and holidays for each of them, shifts made of (begin, end) pairs in increasing order,
+    # at least two operators qualified for each step
+    operator_names = [f"Operator{id + 1}" for id in range(len(data["Operators"]))]
+    for name in operator_names:
+        if name not in data["OperatorWorkHours"]:
+            problems.append(f"{name}: no work hours")
+            continue
+        if name not in data["OperatorHolidays"]:
+            problems.append(f"{name}: no holidays entry")
+        for weekday, daily_shift in data["OperatorWorkHours"][name].items():
+            if weekday not in WEEKDAYS:
+                problems.append(f"{name}: unknown day {weekday} in the work hours")
+            boundaries = [pd.Timedelta(hour) for hour in daily_shift.values()]
+            if len(boundaries) % 2:
+                problems.append(f"{name}: odd number of shift boundaries on {weekday} ({len(boundaries)})")
+            if any(later <= earlier for earlier, later in zip(boundaries, boundaries[1:])):
+                problems.append(f"{name}: shift boundaries of {weekday} are not in increasing order")
+
+    for first, last in data["CERNHolidays"] + [holiday for holidays in data["OperatorHolidays"].values()
+                                               for holiday in holidays]:
+        if datetime.fromisoformat(last) < datetime.fromisoformat(first):
+            problems.append(f"Holidays: {first} - {last} ends before it begins")
+
+    qualified = {name: 0 for name in step_names}
+    for skills in data["Operators"].values():
+        for skill in set(skills):
+            if skill in qualified:
+                qualified[skill] += 1
+    for step in data["StagesAndSteps"]:
+        if step["Previous"][0] != "None" and qualified[step["Step"]] < 2:
+            problems.append(f"Step {step['Step']}: {qualified[step['Step']]} qualified operator(s), 2 are needed")
+
+    simulation_start, simulation_end = simulation_period(data)
+    if simulation_end <= simulation_start:
+        problems.append(f"Simulation period: {simulation_end} is not after {simulation_start}")
+    return problems
+
+
+# Flattens a list of arrays in one array and the offsets of each of them
+def flatten(arrays: list, dtype) -> tuple:
+    lengths = [len(array) for array in arrays]
+    values = np.concatenate(arrays).astype(dtype) if arrays and sum(lengths) else np.empty(0, dtype=dtype)
+    return values, np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def unflatten(values: np.ndarray, offsets: np.ndarray) -> list:
+    return [values[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+
+
+@dataclass
+class CompiledScenario:
+    key: str
+    data: dict
+    inventory: pd.DataFrame
+    step_names: list
+    previous_indices: list  # For each step, indices of its previous steps (empty for the first steps)
+    durations: np.ndarray  # ns
+    required: np.ndarray  # ns
+    capacities: np.ndarray
+    operator_names: list
+    skills: np.ndarray  # operators x steps
+    slot_begins: list  # For each operator, sorted ns beginnings of the slots of work
+    slot_ends: list
+    entry_dates: list  # For each step, entry dates of the modules of the initial inventory, in the order of the log
+
+    def operators(self) -> list:
+        return [Operator(name=name, skills=list(self.data["Operators"][key]))
+                for name, key in zip(self.operator_names, self.data["Operators"])]
+
+    def calendar(self) -> OperatorsCalendar:
+        return OperatorsCalendar(list(self.operator_names), list(self.slot_begins), list(self.slot_ends))
+
+    # Steps with their logs holding the initial inventory
+    def steps(self) -> dict:
+        Chronologically_Ordered_Steps = {}
+        for index, name in enumerate(self.step_names):
+            duration = timedelta(microseconds=int(self.durations[index]) // 1000)
+            previous_steps = [Chronologically_Ordered_Steps[self.step_names[previous]]
+                              for previous in self.previous_indices[index]] or [None]
+            step = Step(name=name, previous_steps=previous_steps, duration=duration,
+                        required=timedelta(microseconds=int(self.required[index]) // 1000),
+                        capacity=int(self.capacities[index]), log=StepLog(duration))
+            for entry_date in self.entry_dates[index]:
+                step.log.add(entry_date)
+            Chronologically_Ordered_Steps[name] = step
+        return Chronologically_Ordered_Steps
+
+
+# Validates and compiles the inputs. Raises a ValueError listing all the problems of invalid inputs.
+def compile_scenario(data: dict, inventory: pd.DataFrame, key=None) -> CompiledScenario:
+    problems = validate_scenario(data, inventory)
+    if problems:
+        raise ValueError("Invalid scenario:\n - " + "\n - ".join(problems))
+
+    simulation_start, simulation_end = simulation_period(data)
+    steps = build_steps(data)
+    fill_initial_inventory(steps, inventory, simulation_start)
+    step_names = list(steps)
+    step_indices = {name: index for index, name in enumerate(step_names)}
+    operators = build_operators(data)
+    calendar = OperatorsCalendar.compile(data, simulation_start, simulation_end)
+
+    skills = np.zeros((len(operators), len(step_names)), dtype=bool)
+    for operator_index, operator in enumerate(operators):
+        for skill in operator.skills:
+            if skill in step_indices:
+                skills[operator_index, step_indices[skill]] = True
+
+    return CompiledScenario(
+        key=key or inputs_hash(data, inventory), data=data, inventory=inventory, step_names=step_names,
+        previous_indices=[[step_indices[previous.name] for previous in step.previous_steps if previous is not None]
+                          for step in steps.values()],
+        durations=np.array([int(step.duration / timedelta(microseconds=1)) * 1000 for step in steps.values()],
+                           dtype=np.int64),
+        required=np.array([int(step.required / timedelta(microseconds=1)) * 1000 for step in steps.values()],
+                          dtype=np.int64),
+        capacities=np.array([step.capacity for step in steps.values()], dtype=np.int64),
+        operator_names=list(calendar.operator_names), skills=skills,
+        slot_begins=list(calendar.begins), slot_ends=list(calendar.ends),
+        entry_dates=[step.log.entry_dates.copy() for step in steps.values()])
+
+
+def save_compiled(compiled: CompiledScenario, path: str) -> None:
+    arrays = {}
+    arrays["previous_indices"], arrays["previous_offsets"] = flatten([np.array(indices) for indices in compiled.previous_indices], np.int64)
+    arrays["durations"], arrays["required"], arrays["capacities"] = compiled.durations, compiled.required, compiled.capacities
+    arrays["skills"] = compiled.skills
+    arrays["slot_begins"], arrays["slot_offsets"] = flatten(compiled.slot_begins, np.int64)
+    arrays["slot_ends"], _ = flatten(compiled.slot_ends, np.int64)
+    arrays["entry_dates"], arrays["entry_offsets"] = flatten(compiled.entry_dates, "datetime64[ns]")
+    arrays["inventory_rows"] = np.array(compiled.inventory.index, dtype=str)
+    arrays["inventory_quantities"] = compiled.inventory["Quantity"].to_numpy(dtype=np.int64)
+    arrays["inventory_launching_times"] = compiled.inventory["Launching Time"].to_numpy(dtype="datetime64[ns]")
+
+    metadata = {"format": COMPILED_FORMAT, "key": compiled.key, "steps": compiled.step_names,
+                "operators": compiled.operator_names}
+    arrays["metadata"] = np.array(json.dumps(metadata))
+    arrays["config"] = np.array(json.dumps(compiled.data))
+
+    with open(path, "wb") as file:
+        np.savez_compressed(file, **arrays)
+
+
+def load_compiled(path: str) -> CompiledScenario:
+    with np.load(path) as archive:
+        metadata = json.loads(str(archive["metadata"]))
+        if metadata["format"] != COMPILED_FORMAT:
+            raise ValueError(f"Compiled scenario {path} has format {metadata['format']}, expected {COMPILED_FORMAT}")
+
+        inventory = pd.DataFrame({"Quantity": pd.array(archive["inventory_quantities"], dtype="Int64"),
+                                  "Launching Time": archive["inventory_launching_times"]},
+                                 index=pd.Index(archive["inventory_rows"].astype(object), name="Steps"))
+        return CompiledScenario(
+            key=metadata["key"], data=json.loads(str(archive["config"])), inventory=inventory,
+            step_names=metadata["steps"],
+            previous_indices=[list(indices) for indices in unflatten(archive["previous_indices"], archive["previous_offsets"])],
+            durations=archive["durations"], required=archive["required"], capacities=archive["capacities"],
+            operator_names=metadata["operators"], skills=archive["skills"],
+            slot_begins=unflatten(archive["slot_begins"], archive["slot_offsets"]),
+            slot_ends=unflatten(archive["slot_ends"], archive["slot_offsets"]),
+            entry_dates=unflatten(archive["entry_dates"], archive["entry_offsets"]))
+
+
+# Loads the compiled scenario of the input files from the cache, compiling (and validating) them on the first use
+def load_or_compile(config_path: str = "SimulatorInputs.json", inventory_path: str = "inventory.csv",
+                    cache_directory: str = CACHE_DIRECTORY) -> CompiledScenario:
+    key = files_hash(config_path, inventory_path)
+    path = os.path.join(cache_directory, f"{key}.npz")
+    if os.path.exists(path):
+        return load_compiled(path)
+
+    with open(config_path, "r") as file:
+        data = json.load(file)
+    compiled = compile_scenario(data, load_inventory(inventory_path), key)
+    os.makedirs(cache_directory, exist_ok=True)
+    # Several processes may compile the same scenario at the same time: each one writes its own temporary file, and the
+    # complete archive is published atomically
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=cache_directory, suffix=".npz")
+    os.close(file_descriptor)
+    try:
+        save_compiled(compiled, temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return compiled
@@ -0,0 +1,357 @@
+import argparse
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from assignments_log import decode
+from compiled_scenario import inputs_hash
+from common import load_config
+from displays import MAX_BARS, RESOLUTIONS, aggregate_workload, metrics_figure, operators_workload, stage_colors, \
+    timeline_figure
+from ensemble import summarize
+from metrics import ProductionMetrics
+from simulation import Simulation
+from TasksHierarchy import load_inventory
+from what_if import operator_absence
+
+# Local planning dashboard (Dash). The simulations run in a background process pool and their results are cached on disk
+# (and the latest ones in memory) under the hash of the scenario: inputs, number of modules, seed and mode. Reopening a
+# plan, or coming back to parameters already tried, is then a cache hit and the requests never run a simulation.
+# The views only get the data of the visible period, at a resolution matching the zoom level: the bars of the Gantt
+# chart are aggregated per period (see displays.aggregate_workload) and the metrics are read from the binned series of
+# the simulation (see metrics.ProductionMetrics).
+# dash is only imported when the application is built, so that the cache and the planner can be used without it.
+
+RESULT_FORMAT: int = 1
+RESULTS_DIRECTORY: str = ".dashboard_cache"
+METRICS_RESOLUTION: timedelta = timedelta(hours=1)
+METRICS_RESOLUTIONS: tuple = tuple(pd.Timedelta(resolution).to_pytimedelta() for resolution in RESOLUTIONS)
+MAX_POINTS: int = 1000  # Above this number of periods in the visible window, the metrics are read at a coarser resolution
+RESULTS_IN_MEMORY: int = 8
+
+
+# Only seeded runs are deterministic, and so can be cached: the seed must be an integer
+def parse_seed(value) -> int:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = float("nan")
+    if isinstance(value, bool) or not number.is_integer():
+        raise ValueError(f"The seed must be an integer, got {value!r}")
+    return int(number)
+
+
+def scenario_key(data: dict, inventory: pd.DataFrame, modules_to_do: int, seed, batch: bool) -> str:
+    content = json.dumps({"format": RESULT_FORMAT, "inputs": inputs_hash(data, inventory), "modules": modules_to_do,
+                          "seed": seed, "batch": batch}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# The inputs of the dashboard: the reference inputs with the capacity of one step changed and/or one operator away
+def tweak_inputs(data: dict, capacity_step=None, capacity=None, absent_operator=None, first=None, last=None) -> dict:
+    if capacity_step and capacity:
+        data = copy.deepcopy(data)
+        for step in data["StagesAndSteps"]:
+            if step["Step"] == capacity_step:
+                step["Capacity"] = int(capacity)
+    if absent_operator and first and last:
+        data = operator_absence(data, absent_operator, datetime.fromisoformat(first), datetime.fromisoformat(last)).data
+    return data
+
+
+# Runs a scenario in a worker process. Returns the metadata and the arrays of the result, as stored in the cache.
+def run_scenario(arguments: tuple) -> tuple:
+    data, inventory, modules_to_do, seed, batch = arguments
+    simulation = Simulation(data, inventory, seed, metrics_resolution=METRICS_RESOLUTION)
+    simulation.run(modules_to_do, batch=batch)
+    summary = summarize(simulation, modules_to_do)
+
+    metrics_metadata, metrics_arrays = simulation.metrics.state()
+    metadata = {"format": RESULT_FORMAT, "steps": list(simulation.steps),
+                "operators": simulation.operators_index.operator_names, "metrics": metrics_metadata,
+                "end_time": str(simulation.time), "modules_completed": simulation.modules_completed,
+                "completion_date": None if pd.isna(summary["completion_date"]) else str(summary["completion_date"])}
+    arrays = {f"metrics_{name}": array for name, array in metrics_arrays.items()}
+    arrays["assignments"] = simulation.assignments.records()
+    return metadata, arrays
+
+
+def save_result(path: str, metadata: dict, arrays: dict) -> None:
+    arrays = dict(arrays, metadata=np.array(json.dumps(metadata)))
+    with open(path + ".tmp", "wb") as file:  # Written aside then renamed, a reader never sees a partial file
+        np.savez_compressed(file, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+# The format of the results is part of the scenario key, a cached result is always in the current format
+def load_result(path: str):
+    with np.load(path) as archive:
+        metadata = json.loads(str(archive["metadata"]))
+        arrays = {name: archive[name] for name in archive.files if name != "metadata"}
+    return PlanResult(metadata, arrays)
+
+
+# A finished simulation, as shown by the dashboard. The aggregated bars of each resolution are only computed once.
+class PlanResult:
+
+    def __init__(self, metadata: dict, arrays: dict):
+        self.metadata: dict = metadata
+        self.step_names: list = metadata["steps"]
+        self.operator_names: list = metadata["operators"]
+        self.assignments: pd.DataFrame = decode(arrays["assignments"], self.step_names, self.operator_names)
+        self.metrics: ProductionMetrics = ProductionMetrics.restore(
+            metadata["metrics"], {name[len("metrics_"):]: array for name, array in arrays.items() if name.startswith("metrics_")})
+        self._workloads: dict = {}
+
+    # Bars of the Gantt chart, one per task (resolution None) or aggregated per period of the resolution
+    def workload(self, resolution=None) -> pd.DataFrame:
+        if resolution not in self._workloads:
+            if resolution is None:
+                self._workloads[None] = operators_workload(self.assignments, dict.fromkeys(self.step_names),
+                                                           self.operator_names)
+            else:
+                self._workloads[resolution] = aggregate_workload(self.workload(), resolution)
+        return self._workloads[resolution]
+
+    def time_range(self) -> tuple:
+        workload = self.workload()
+        if workload.empty:
+            return self.metrics.start, pd.Timestamp(self.metadata["end_time"])
+        return workload["Start"].min(), workload["End"].max()
+
+    # Bars of the visible window at the finest resolution giving at most max_bars bars, and that resolution
+    def gantt_bars(self, begin, end, max_bars: int = MAX_BARS) -> tuple:
+        begin, end = np.datetime64(begin, "ns"), np.datetime64(end, "ns")
+        for resolution in (None,) + RESOLUTIONS:
+            workload = self.workload(resolution)
+            visible = (workload["Start"].values < end) & (workload["End"].values > begin)
+            if visible.sum() <= max_bars or resolution == RESOLUTIONS[-1]:
+                return workload[visible], resolution
+
+    # Finest resolution of the metrics giving at most max_points periods in the visible window
+    def metrics_resolution(self, begin, end, max_points: int = MAX_POINTS) -> timedelta:
+        duration = pd.Timestamp(end) - pd.Timestamp(begin)
+        for resolution in METRICS_RESOLUTIONS:
+            if duration / resolution <= max_points:
+                return resolution
+        return METRICS_RESOLUTIONS[-1]
+
+
+# Runs the scenarios in a background process pool and keeps their results, on disk and the latest ones in memory
+class Planner:
+
+    def __init__(self, directory: str = RESULTS_DIRECTORY, workers=None):
+        self.directory: str = directory
+        os.makedirs(directory, exist_ok=True)
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._running: set = set()
+        self._errors: dict = {}
+        self._results: OrderedDict = OrderedDict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npz")
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.workers)
+        return self._pool
+
+    # Starts the simulation of the scenario in the background, unless its result is already cached or on its way.
+    # Returns the key of the scenario.
+    def submit(self, data: dict, inventory: pd.DataFrame, modules_to_do: int, seed, batch: bool = False) -> str:
+        seed = parse_seed(seed)
+        key = scenario_key(data, inventory, modules_to_do, seed, batch)
+        with self._lock:
+            if key in self._results or key in self._running or os.path.exists(self._path(key)):
+                return key
+            self._running.add(key)
+            self._errors.pop(key, None)
+        self.pool.apply_async(run_scenario, ((data, inventory, modules_to_do, seed, batch),),
+                              callback=lambda result: self._store(key, result),
+                              error_callback=lambda error: self._fail(key, error))
+        return key
+
+    # Runs in the result handler thread of the pool, a failed save (disk full...) is reported like a failed run
+    def _store(self, key: str, result: tuple) -> None:
+        try:
+            save_result(self._path(key), *result)
+        except Exception as error:
+            self._fail(key, error)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def _fail(self, key: str, error: BaseException) -> None:
+        with self._lock:
+            self._running.discard(key)
+            self._errors[key] = f"{type(error).__name__}: {error}"
+
+    # "running", "ready", "failed: <error>" or "unknown"
+    def status(self, key: str) -> str:
+        with self._lock:
+            if key in self._running:
+                return "running"
+            if key in self._errors:
+                return f"failed: {self._errors[key]}"
+        return "ready" if key in self._results or os.path.exists(self._path(key)) else "unknown"
+
+    # Result of the scenario, None if it is not ready
+    def result(self, key: str):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+        if not os.path.exists(self._path(key)):
+            return None
+        result = load_result(self._path(key))
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > RESULTS_IN_MEMORY:
+                self._results.popitem(last=False)
+        return result
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+# Visible period of a graph after a zoom or a pan (on any of its x axes), the default one after a reset of the axes
+def visible_window(relayout_data, default: tuple) -> tuple:
+    if not relayout_data:
+        return default
+    for name, value in relayout_data.items():
+        axis, _, attribute = name.partition(".")
+        if not axis.startswith("xaxis"):
+            continue
+        if attribute == "autorange" and value:
+            return default
+        if attribute == "range[0]":
+            return pd.Timestamp(value), pd.Timestamp(relayout_data[f"{axis}.range[1]"])
+        if attribute == "range":
+            return pd.Timestamp(value[0]), pd.Timestamp(value[1])
+    return default
+
+
+def gantt_view(result: PlanResult, window: tuple):
+    bars, resolution = result.gantt_bars(*window)
+    figure = timeline_figure(bars, dict.fromkeys(result.step_names), stage_colors(result.step_names))
+    figure.update_yaxes(categoryorder="array", categoryarray=result.operator_names, autorange="reversed")
+    figure.update_layout(title=f"Operators workload ({'one bar per task' if resolution is None else f'per {resolution}'})",
+                         xaxis=dict(range=list(window)), uirevision="gantt", legend=dict(traceorder="normal"))
+    return figure
+
+
+def metrics_view(result: PlanResult, window: tuple):
+    resolution = result.metrics_resolution(*window)
+    figure = metrics_figure(result.metrics, resolution, show=False)
+    figure.update_layout(xaxis=dict(range=list(window)), uirevision="metrics")
+    return figure
+
+
+def build_app(data: dict, inventory: pd.DataFrame, planner: Planner):
+    import plotly.graph_objs as go
+    from dash import Dash, Input, Output, State, dcc, html, no_update
+
+    step_names = [step["Step"] for step in data["StagesAndSteps"]]
+    operator_names = list(data["Operators"])
+    app = Dash(__name__, title="Planning ITk")
+
+    app.layout = html.Div([
+        html.H2("Planning ITk"),
+        html.Div([
+            html.Label("Modules"), dcc.Input(id="modules", type="number", min=1, value=data["SimulationParameters"]["num_modules"]),
+            html.Label("Seed"), dcc.Input(id="seed", type="number", value=0),
+            dcc.Checklist(id="batch", options=[{"label": "Batch assignments", "value": "batch"}], value=[]),
+        ]),
+        html.Div([
+            html.Label("Capacity of"), dcc.Dropdown(id="capacity-step", options=step_names, style={"width": "400px"}),
+            dcc.Input(id="capacity", type="number", min=1),
+        ]),
+        html.Div([
+            html.Label("Absence of"), dcc.Dropdown(id="absent-operator", options=operator_names, style={"width": "200px"}),
+            dcc.DatePickerRange(id="absence"),
+        ]),
+        html.Button("Run", id="run"),
+        html.Div(id="status"),
+        dcc.Store(id="key"),
+        dcc.Store(id="ready-key"),
+        dcc.Interval(id="poll", interval=1000, disabled=True),
+        dcc.Graph(id="gantt", figure=go.Figure()),
+        dcc.Graph(id="metrics", figure=go.Figure(), style={"height": "900px"}),
+    ])
+
+    @app.callback(Output("key", "data"), Output("poll", "disabled"),
+                  Output("status", "children", allow_duplicate=True), Input("run", "n_clicks"),
+                  State("modules", "value"), State("seed", "value"), State("batch", "value"),
+                  State("capacity-step", "value"), State("capacity", "value"), State("absent-operator", "value"),
+                  State("absence", "start_date"), State("absence", "end_date"), prevent_initial_call=True)
+    def submit(_, modules_to_do, seed, batch, capacity_step, capacity, absent_operator, first, last):
+        try:
+            seed = parse_seed(seed)
+        except ValueError as error:
+            return no_update, True, str(error)
+        scenario = tweak_inputs(data, capacity_step, capacity, absent_operator, first, last)
+        key = planner.submit(scenario, inventory, int(modules_to_do), seed, "batch" in (batch or []))
+        return key, False, "Simulation running"
+
+    @app.callback(Output("status", "children"), Output("ready-key", "data"), Output("poll", "disabled", allow_duplicate=True),
+                  Input("poll", "n_intervals"), Input("key", "data"), prevent_initial_call=True)
+    def poll(_, key):
+        status = planner.status(key)
+        if status != "ready":
+            return f"Simulation {status}", no_update, status != "running"
+        metadata = planner.result(key).metadata
+        return (f"{metadata['modules_completed']} modules shipped, the last requested one on "
+                f"{metadata['completion_date']}"), key, True
+
+    @app.callback(Output("gantt", "figure"), Input("ready-key", "data"), Input("gantt", "relayoutData"),
+                  prevent_initial_call=True)
+    def gantt(key, relayout_data):
+        result = planner.result(key)
+        if result is None:
+            return no_update
+        return gantt_view(result, visible_window(relayout_data, result.time_range()))
+
+    @app.callback(Output("metrics", "figure"), Input("ready-key", "data"), Input("metrics", "relayoutData"),
+                  prevent_initial_call=True)
+    def metrics(key, relayout_data):
+        result = planner.result(key)
+        if result is None:
+            return no_update
+        return metrics_view(result, visible_window(relayout_data, result.time_range()))
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planning dashboard of the production simulation")
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-directory", default=RESULTS_DIRECTORY)
+    parser.add_argument("--debug", action="store_true")
+    arguments = parser.parse_args()
+
+    planner = Planner(arguments.cache_directory, arguments.workers)
+    app = build_app(load_config(arguments.config), load_inventory(arguments.inventory), planner)
+    try:
+        app.run(port=arguments.port, debug=arguments.debug)
+    finally:
+        planner.close()
+
+
+if __name__ == "__main__":
+    main()
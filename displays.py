@@ -1,106 +1,169 @@
 import pandas as pd
-import plotly.graph_objs as go
-import plotly.express as px
-
-from common import Chronologically_Ordered_Steps, operators, Operator
-
-# For each operator we will have to create a data frame of his assignments, per time and task. Then we'll
-# display all those dataframe on the same timeline
-
-def Display(operators_assignments: pd.DataFrame):
-
-    color_palette = [
-        'rgba(135, 206, 235, 0.6)',  # skyblue
-        'rgba(255, 165, 0, 0.6)',  # orange
-        'rgba(0, 128, 0, 0.6)',  # green
-        'rgba(255, 0, 0, 0.6)',  # red
-        'rgba(128, 0, 128, 0.6)',  # purple
-        'rgba(165, 42, 42, 0.6)',  # brown
-        'rgba(128, 128, 128, 0.6)',  # grey
-        'rgba(0, 128, 128, 0.6)',  # teal
-        'rgba(255, 192, 203, 0.6)',  # pink
-        'rgba(0, 0, 255, 0.6)',  # blue
-        'rgba(255, 255, 0, 0.6)'  # yellow
-    ]
-    stage_colors = {}
-    for idx, stage in enumerate(list(Chronologically_Ordered_Steps.keys())):
-        stage_colors[stage] = color_palette[idx % len(color_palette)]
-
-    def custom_function(value, col, idx):
-        if value == 0:
-            return 0
-        else:
-            return (Chronologically_Ordered_Steps[col].required + idx)
-
-    def is_operator_in_row(operator: Operator, row: pd.Series) -> bool:
-        row_values = row[row.notna()]
-        for duo in row_values:
-            if operator.name in duo:
-                return True
-        return False
-
-    operators_workload = pd.DataFrame()
-
-    for operator in operators:
-        operator_assignments = pd.DataFrame()
-        # Returns the dataframe of all assignment of the operator
-        operator_assignments = operators_assignments[
-            operators_assignments.apply(lambda row: is_operator_in_row(operator, row), axis=1)
-        ]
-
-        operator_assignments = operator_assignments.notna().astype(int)
-
-        # Modification of the dataframe to have something displayable
-        operator_assignments = pd.DataFrame(
-            [[custom_function(operator_assignments.loc[idx, col], col, idx) for col in operator_assignments.columns] for
-             idx
-             in operator_assignments.index],
-            index=operator_assignments.index,
-            columns=operator_assignments.columns
-        )
-
-        operator_df = operator_assignments.apply(
-            lambda row: pd.Series({
-                'Start': row.name,
-                'End': row[row != 0].iloc[0],
-                'Step': row[row != 0].index[0] if not row[row != 0].empty else None,
-                'name': operator.name
-            }),
-            axis=1
-        ).dropna()
-
-        operator_df.reset_index(drop=True, inplace=True)
-
-        operators_workload = pd.concat([operators_workload, operator_df], ignore_index=True)
+
+from assignments_log import from_wide
+
+# For each operator we build the table of his assignments, per time and task. Then we display all those tables on the
+# same timeline.
+#
+# The table is built in one vectorized pass from the long format assignments (one row per task, see assignments_log):
+# each task gives one bar for each of its two operators. Multi-year plans have too many bars for an SVG timeline, so
+# they are either aggregated (the consecutive tasks of an operator on the same step within a period of the chosen
+# resolution are merged into one bar) or drawn with WebGL traces.
+# plotly is only imported when a figure is built, so that the simulation starts without it.
+
+MAX_BARS: int = 5000  # Above this number of bars, the "auto" mode aggregates them
+RESOLUTIONS: tuple = ("1h", "4h", "1D", "7D", "30D")  # Aggregation periods, from the finest to the coarsest
+
+
+COLOR_PALETTE: list = [
+    'rgba(135, 206, 235, 0.6)',  # skyblue
+    'rgba(255, 165, 0, 0.6)',  # orange
+    'rgba(0, 128, 0, 0.6)',  # green
+    'rgba(255, 0, 0, 0.6)',  # red
+    'rgba(128, 0, 128, 0.6)',  # purple
+    'rgba(165, 42, 42, 0.6)',  # brown
+    'rgba(128, 128, 128, 0.6)',  # grey
+    'rgba(0, 128, 128, 0.6)',  # teal
+    'rgba(255, 192, 203, 0.6)',  # pink
+    'rgba(0, 0, 255, 0.6)',  # blue
+    'rgba(255, 255, 0, 0.6)'  # yellow
+]
+
+
+# Color of the bars of each step, in the order of the steps
+def stage_colors(step_names) -> dict:
+    return {step_name: COLOR_PALETTE[index % len(COLOR_PALETTE)] for index, step_name in enumerate(step_names)}
+
+
+# One row per operator and task (Start, End, Step, name), ordered by operator then time. The operators are given as
+# objects with a name, or as their names.
+def operators_workload(assignments: pd.DataFrame, Chronologically_Ordered_Steps: dict, operators: list) -> pd.DataFrame:
+    if "operator_a" not in assignments.columns:  # Legacy wide frame
+        assignments = from_wide(assignments, {name: step.required for name, step in Chronologically_Ordered_Steps.items()})
+
+    workload = pd.concat([
+        pd.DataFrame({"Start": assignments["time"].values, "End": assignments["end"].values,
+                      "Step": assignments["step"].astype(str).values, "name": assignments[column].astype(str).values})
+        for column in ("operator_a", "operator_b")
+    ], ignore_index=True)
+
+    operator_order = {getattr(operator, "name", operator): index for index, operator in enumerate(operators)}
+    workload = workload[workload["name"].isin(operator_order)]
+    workload = workload.assign(order=workload["name"].map(operator_order))
+    return workload.sort_values(["order", "Start"], kind="stable").drop(columns="order").reset_index(drop=True)
+
+
+# Merges the tasks of each operator on each step within each period of the given resolution into one bar going from
+# the start of the first task to the end of the last one
+def aggregate_workload(workload: pd.DataFrame, resolution: str) -> pd.DataFrame:
+    periods = workload["Start"].dt.floor(resolution)
+    return workload.groupby(["name", "Step", periods.rename("Period")], sort=False, observed=True).agg(
+        Start=("Start", "min"), End=("End", "max"), Tasks=("Start", "size")).reset_index().drop(columns="Period")
+
+
+# Finest resolution giving at most max_bars bars
+def choose_resolution(workload: pd.DataFrame, max_bars: int = MAX_BARS) -> str:
+    for resolution in RESOLUTIONS:
+        bars = workload.groupby(["name", "Step", workload["Start"].dt.floor(resolution)], observed=True).ngroups
+        if bars <= max_bars:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def timeline_figure(workload: pd.DataFrame, Chronologically_Ordered_Steps: dict, stage_colors: dict):
+    import plotly.express as px
+
+    hover_data = ["Step", "Tasks"] if "Tasks" in workload.columns else ["Step"]
+    return px.timeline(
+        workload,
+        x_start="Start",
+        x_end="End",
+        y="name",
+        color="Step",
+        hover_data=hover_data,
+        color_discrete_map=stage_colors,
+        category_orders={"Stage": list(Chronologically_Ordered_Steps.keys())}
+    )
+
+
+# Each bar is drawn as a thick horizontal segment, the segments of a step being separated by gaps in a single trace
+def webgl_figure(workload: pd.DataFrame, Chronologically_Ordered_Steps: dict, stage_colors: dict, operators: list):
+    import plotly.graph_objs as go
+
+    fig = go.Figure()
+    for step_name in Chronologically_Ordered_Steps:
+        bars = workload[workload["Step"] == step_name]
+        if bars.empty:
+            continue
+        x = pd.DataFrame({"Start": bars["Start"].values, "End": bars["End"].values, "Gap": pd.NaT}).to_numpy().ravel()
+        y = pd.DataFrame({"Start": bars["name"].values, "End": bars["name"].values, "Gap": None}).to_numpy().ravel()
+        fig.add_trace(go.Scattergl(x=x, y=y, mode="lines", name=step_name, line=dict(width=12, color=stage_colors[step_name]),
+                                   connectgaps=False, hovertemplate=f"{step_name}<br>%{{x}}<extra>%{{y}}</extra>"))
+    fig.update_yaxes(categoryorder="array", categoryarray=[getattr(operator, "name", operator) for operator in operators], autorange="reversed")
+    return fig
+
+
+# mode is "timeline" (one bar per task), "aggregate" (bars merged per period of the given resolution, chosen from the
+# number of bars if None), "webgl" (one bar per task, drawn with WebGL) or "auto" (timeline, or aggregate above
+# MAX_BARS bars). The assignments are either in long format or in the legacy wide format.
+def Display(operators_assignments: pd.DataFrame, Chronologically_Ordered_Steps: dict, operators: list,
+            mode: str = "auto", resolution=None, show: bool = True):
+
+    colors = stage_colors(Chronologically_Ordered_Steps.keys())
+
+    workload = operators_workload(operators_assignments, Chronologically_Ordered_Steps, operators)
+
     # Generate Operator Workload Plot
     print("Generating Operator Workload Plot...")
 
-    if not operators_workload.empty:
-
-        fig_operator = px.timeline(
-            operators_workload,
-            x_start="Start",
-            x_end="End",
-            y="name",
-            color="Step",
-            hover_data=['Step'],
-            color_discrete_map=stage_colors,
-            category_orders={"Stage": list(Chronologically_Ordered_Steps.keys())}
-        )
-
-        fig_operator.update_layout(
-            title='Planning Interactif Production ITK',
-            xaxis_title='Time',
-            yaxis_title='Operator',
-            xaxis=dict(
-                tickformat='%Y-%m-%d %H:%M',
-                rangeslider=dict(visible=True),
-            ),
-            hovermode='x unified',
-            legend=dict(traceorder='normal')  # Preserve the order of legend entries
-        )
-
-        fig_operator.show()
-    else:
+    if workload.empty:
         print("No operator tasks were scheduled.")
+        return None
+
+    if mode == "auto":
+        mode = "timeline" if len(workload) <= MAX_BARS else "aggregate"
+    if mode == "aggregate":
+        workload = aggregate_workload(workload, resolution or choose_resolution(workload))
 
+    if mode == "webgl":
+        fig_operator = webgl_figure(workload, Chronologically_Ordered_Steps, colors, operators)
+    elif mode in ("timeline", "aggregate"):
+        fig_operator = timeline_figure(workload, Chronologically_Ordered_Steps, colors)
+    else:
+        raise ValueError(f"Unknown display mode {mode}, expected auto, timeline, aggregate or webgl")
+
+    fig_operator.update_layout(
+        title='Planning Interactif Production ITK',
+        xaxis_title='Time',
+        yaxis_title='Operator',
+        xaxis=dict(
+            tickformat='%Y-%m-%d %H:%M',
+            rangeslider=dict(visible=mode != "webgl"),  # The range slider does not render WebGL traces
+        ),
+        hovermode='x unified',
+        legend=dict(traceorder='normal')  # Preserve the order of legend entries
+    )
+
+    if show:
+        fig_operator.show()
+    return fig_operator
+
+
+# Throughput, WIP per stage and workload of the operators over time, read from the series of the production metrics
+# (see metrics.ProductionMetrics), at the given resolution (a multiple of the resolution of the metrics)
+def metrics_figure(metrics, resolution=None, show: bool = True):
+    import plotly.graph_objs as go
+    from plotly.subplots import make_subplots
+
+    times = metrics.times(resolution)
+    fig = make_subplots(rows=3, cols=1, shared_xaxes=True,
+                        subplot_titles=("Modules shipped", "Modules per stage", "Operator workload (hours)"))
+    fig.add_trace(go.Scatter(x=times, y=metrics.shipped(resolution), name="Shipped", line_shape="hv"), row=1, col=1)
+    for stage, wip in zip(metrics.stage_names, metrics.wip(resolution)):
+        fig.add_trace(go.Scatter(x=times, y=wip, name=stage, stackgroup="wip", line_shape="hv"), row=2, col=1)
+    for operator, busy_minutes in zip(metrics.operator_names, metrics.busy_minutes(resolution)):
+        fig.add_trace(go.Bar(x=times, y=busy_minutes / 60, name=operator), row=3, col=1)
+    fig.update_layout(title="Production metrics", barmode="stack", hovermode="x unified")
+    if show:
+        fig.show()
+    return fig
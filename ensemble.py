@@ -0,0 +1,143 @@
+import argparse
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from common import SHIPMENT_STEP, load_config
+from simulation import Simulation
+from step_log import to_ns
+from TasksHierarchy import load_inventory
+
+# Monte Carlo ensemble of the simulation: the operators are chosen at random in assign_operators, so N independently
+# seeded replicas are run in a process pool to see how spread out the completion dates are.
+# Each worker process builds one Simulation and resets it with the seed of every replica it runs.
+
+PERCENTILES: tuple = (5, 25, 50, 75, 95)
+
+
+# Reproducible seeds of the replicas, derived from a single base seed
+def replica_seeds(base_seed: int, replicas: int) -> list:
+    return [int(sequence.generate_state(1)[0]) for sequence in np.random.SeedSequence(base_seed).spawn(replicas)]
+
+
+# Modules out of the step: the ones that left it, all the ones that entered it for the shipment step (shipped)
+def stage_outputs(step) -> int:
+    if step.name == SHIPMENT_STEP:
+        return len(step.log)
+    return int((~np.isnat(step.log.exit_dates)).sum())
+
+
+# Summary of a finished simulation: date at which the last requested module was shipped, number of modules out of each
+# stage per week (modules that left the last step of the stage, or shipped for the last stage), and share of the
+# on-shift time of each operator spent on tasks
+def summarize(simulation: Simulation, modules_to_do: int) -> dict:
+    end_time: datetime = simulation.time
+    operators_calendar = simulation.operators_calendar
+
+    shipments = np.sort(simulation.steps[SHIPMENT_STEP].log.entry_dates)
+    completion_date = pd.Timestamp(shipments[modules_to_do - 1]) if len(shipments) >= modules_to_do else pd.NaT
+
+    weeks: float = max((end_time - simulation.simulation_start) / timedelta(weeks=1), 1e-9)
+    last_step_of_stage = {step["Stage"]: step["Step"] for step in simulation.data["StagesAndSteps"]}
+    throughput = {stage: stage_outputs(simulation.steps[step_name]) / weeks
+                  for stage, step_name in last_step_of_stage.items()}
+
+    records = simulation.assignments.records()
+    durations = (records["end"] - records["time"]).astype(np.int64)
+    busy_ns = np.zeros(len(operators_calendar.operator_names), dtype=np.int64)
+    np.add.at(busy_ns, records["operator_a"], durations)
+    np.add.at(busy_ns, records["operator_b"], durations)
+
+    utilization = {}
+    start_ns, end_ns = to_ns(simulation.simulation_start), to_ns(end_time)
+    for operator_index, name in enumerate(operators_calendar.operator_names):
+        begins = np.clip(operators_calendar.begins[operator_index], start_ns, end_ns)
+        ends = np.clip(operators_calendar.ends[operator_index], start_ns, end_ns)
+        on_shift = timedelta(microseconds=int((ends - begins).sum()) // 1000)
+        busy = timedelta(microseconds=int(busy_ns[operator_index]) // 1000)
+        utilization[name] = busy / on_shift if on_shift else np.nan
+
+    return {"completion_date": completion_date, "end_time": end_time, "throughput": throughput,
+            "utilization": utilization}
+
+
+# Simulation of the worker process, built once by the initializer of the pool
+worker_simulation = None
+
+
+def init_worker(data: dict, inventory: pd.DataFrame) -> None:
+    global worker_simulation
+    worker_simulation = Simulation(data, inventory)
+
+
+# Runs one replica in a worker process
+def run_replica(arguments: tuple) -> dict:
+    replica, seed, modules_to_do = arguments
+    worker_simulation.reset(seed)
+    worker_simulation.run(modules_to_do)
+    return {"replica": replica, "seed": seed} | summarize(worker_simulation, modules_to_do)
+
+
+# Yields the summaries of the replicas as soon as they are finished (not in the order of the replicas)
+def iter_ensemble(data: dict, inventory: pd.DataFrame, replicas: int, modules_to_do: int, base_seed: int = 0,
+                  workers=None):
+    seeds = replica_seeds(base_seed, replicas)
+    with multiprocessing.Pool(processes=workers or os.cpu_count(), initializer=init_worker,
+                              initargs=(data, inventory)) as pool:
+        yield from pool.imap_unordered(run_replica, [(replica, seed, modules_to_do) for replica, seed in enumerate(seeds)])
+
+
+# Percentiles over the replicas of the completion date, of the throughput of each stage and of the utilization of each
+# operator. Each row of the returned dataframe is a quantity, each column a percentile.
+def aggregate(summaries: list, percentiles: tuple = PERCENTILES) -> pd.DataFrame:
+    columns = [f"p{percentile}" for percentile in percentiles]
+    rows = {}
+
+    completion_dates = pd.Series([summary["completion_date"] for summary in summaries], dtype="datetime64[ns]").dropna()
+    if len(completion_dates):
+        values = np.percentile(completion_dates.astype(np.int64), percentiles, method="nearest")
+        rows["completion_date"] = [pd.Timestamp(value) for value in values]
+
+    for key in ("throughput", "utilization"):
+        table = pd.DataFrame([summary[key] for summary in summaries])
+        for name in table.columns:
+            rows[f"{key} {name}"] = list(np.nanpercentile(table[name].astype(float), percentiles))
+
+    return pd.DataFrame.from_dict(rows, orient="index", columns=columns)
+
+
+def run_ensemble(data: dict, inventory: pd.DataFrame, replicas: int, modules_to_do: int, base_seed: int = 0,
+                 workers=None, on_replica=None) -> tuple:
+    summaries = []
+    for summary in iter_ensemble(data, inventory, replicas, modules_to_do, base_seed, workers):
+        summaries.append(summary)
+        if on_replica is not None:
+            on_replica(summary)
+    summaries.sort(key=lambda summary: summary["replica"])
+    return summaries, aggregate(summaries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo ensemble of the production simulation")
+    parser.add_argument("modules", type=int, help="Number of modules to simulate")
+    parser.add_argument("--replicas", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0, help="Base seed from which the seeds of the replicas are derived")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (all the cores by default)")
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    arguments = parser.parse_args()
+
+    def print_replica(summary: dict) -> None:
+        print(f"Replica {summary['replica']} (seed {summary['seed']}): module {arguments.modules} shipped on {summary['completion_date']}")
+
+    _, percentiles = run_ensemble(load_config(arguments.config), load_inventory(arguments.inventory), arguments.replicas,
+                                  arguments.modules, arguments.seed, arguments.workers, print_replica)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(percentiles)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import json
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+
+import simulation_engine
+from benchmark import BASE_SCENARIO, DEFAULT_SUITE, generate_scenario, suite_scenarios
+from common import load_config
+from compiled_scenario import flatten, inputs_hash, unflatten
+from simulation import Simulation
+from step_log import StepLog, to_ns
+from TasksHierarchy import load_inventory, tasks_by_priority
+
+# Golden traces: every decision of a run, to check that an optimization of the engine does not change the schedules.
+# For each query of the ready tasks that returned tasks, the trace keeps the clock, the list of the ready tasks and a
+# snapshot of the logs (number of modules that entered each step, and number still in it). For each task done, it keeps
+# the query it came from, its time, the candidate operators (qualified, on shift and free), the chosen pair and the log
+# updates (index of the module added to the step, indices of the modules taken from the previous steps).
+# The runs are seeded, so two code paths that are meant to be equivalent give the same trace; the first difference
+# between two traces is the first divergence of the schedules. The traces are stored in compressed npz files.
+#
+# The recorder wraps the functions of simulation_engine (like benchmark.timed_functions), so the engine itself carries
+# no recording code.
+
+TRACE_FORMAT: int = 1
+
+
+@dataclass
+class GoldenTrace:
+    metadata: dict
+    query_clocks: np.ndarray  # ns
+    ready_steps: list  # One array of step codes per query, in the order of priority
+    snapshot_lengths: np.ndarray  # queries x steps
+    snapshot_open: np.ndarray  # queries x steps
+    decision_queries: np.ndarray
+    decision_times: np.ndarray  # ns
+    decision_steps: np.ndarray
+    operators_a: np.ndarray
+    operators_b: np.ndarray
+    candidates: np.ndarray  # decisions x operators
+    entered: np.ndarray
+    popped: list  # One array of module indices per decision, one per previous step
+
+    @property
+    def steps(self) -> list:
+        return self.metadata["steps"]
+
+    @property
+    def operators(self) -> list:
+        return self.metadata["operators"]
+
+
+# A difference between two traces: what differs (kind), at which query or decision (index) and simulated time (clock)
+@dataclass
+class Divergence:
+    kind: str
+    index: int
+    clock: object
+    expected: object
+    actual: object
+
+    def __str__(self):
+        return f"First divergence at {self.kind} #{self.index} ({self.clock}): expected {self.expected}, got {self.actual}"
+
+
+class TraceRecorder:
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+        self.step_codes: dict = {name: code for code, name in enumerate(simulation.steps)}
+        self.operator_codes: dict = {name: code for code, name in enumerate(simulation.operators_index.operator_names)}
+        self.query_clocks, self.ready_steps, self.snapshot_lengths, self.snapshot_open = [], [], [], []
+        self.decision_queries, self.decision_times, self.decision_steps = [], [], []
+        self.operators_a, self.operators_b, self.candidates, self.entered, self.popped = [], [], [], [], []
+        self._pairs: deque = deque()
+        self._candidates: deque = deque()
+        self._batch_candidates: dict = {}
+        self._popping = None
+        self._next_observer = None
+
+    def query(self, tasks: list) -> None:
+        if not tasks:
+            return
+        steps = self.simulation.steps.values()
+        self.query_clocks.append(to_ns(self.simulation.time))
+        self.ready_steps.append(np.array([self.step_codes[task.name] for task in tasks], dtype=np.int16))
+        self.snapshot_lengths.append(np.array([len(step.log) for step in steps], dtype=np.int32))
+        self.snapshot_open.append(np.array([step.log.open_count for step in steps], dtype=np.int32))
+
+    # Notified by the assignment recorder, the pairs are consumed in the same order by the log updates
+    def assign(self, time, end, operator_a: str, operator_b: str) -> None:
+        self._pairs.append((self.operator_codes[operator_a], self.operator_codes[operator_b]))
+        if self._next_observer is not None:
+            self._next_observer.assign(time, end, operator_a, operator_b)
+
+    def decision(self, task, time, popped: list) -> None:
+        self.decision_queries.append(len(self.query_clocks) - 1)
+        self.decision_times.append(to_ns(time))
+        self.decision_steps.append(self.step_codes[task.name])
+        operator_a, operator_b = self._pairs.popleft() if self._pairs else (-1, -1)
+        self.operators_a.append(operator_a)
+        self.operators_b.append(operator_b)
+        if self._candidates:
+            self.candidates.append(self._candidates.popleft())
+        else:
+            self.candidates.append(self._batch_candidates.get(task.name, np.zeros(len(self.operator_codes), dtype=bool)))
+        self.entered.append(len(task.log) - 1)
+        self.popped.append(np.array(popped, dtype=np.int64))
+
+    def trace(self) -> GoldenTrace:
+        simulation = self.simulation
+        metadata = {"format": TRACE_FORMAT, "inputs_hash": inputs_hash(simulation.data, simulation.inventory),
+                    "seed": simulation.seed, "steps": list(self.step_codes), "operators": list(self.operator_codes),
+                    "end_time": str(simulation.time), "modules_completed": simulation.modules_completed}
+        steps, operators = len(self.step_codes), len(self.operator_codes)
+        return GoldenTrace(
+            metadata, np.array(self.query_clocks, dtype=np.int64), self.ready_steps,
+            np.array(self.snapshot_lengths, dtype=np.int32).reshape(-1, steps),
+            np.array(self.snapshot_open, dtype=np.int32).reshape(-1, steps),
+            np.array(self.decision_queries, dtype=np.int64), np.array(self.decision_times, dtype=np.int64),
+            np.array(self.decision_steps, dtype=np.int16), np.array(self.operators_a, dtype=np.int16),
+            np.array(self.operators_b, dtype=np.int16),
+            np.array(self.candidates, dtype=bool).reshape(-1, operators), np.array(self.entered, dtype=np.int64),
+            self.popped)
+
+
+# Records the decisions of the simulation while the block runs (the simulation must not be reset or loaded from a
+# checkpoint inside the block). The trace is built by recorder.trace() at the end.
+@contextmanager
+def recording(simulation: Simulation):
+    recorder = TraceRecorder(simulation)
+    originals = {name: getattr(simulation_engine, name)
+                 for name in ("ready_tasks", "tasks_by_priority", "get_available_operators", "update_log")}
+    original_pop_ready = StepLog.pop_ready
+    original_available_by_step = simulation.operators_index.available_by_step
+
+    def ready_tasks(*arguments):
+        tasks = originals["ready_tasks"](*arguments)
+        recorder.query(tasks)
+        return tasks
+
+    def legacy_tasks_by_priority(*arguments):
+        tasks = originals["tasks_by_priority"](*arguments)
+        recorder.query(tasks)
+        return tasks
+
+    def get_available_operators(time, task, operators, operators_index):
+        available = originals["get_available_operators"](time, task, operators, operators_index)
+        names = {operator.name for operator in available}
+        recorder._candidates.append(np.array([name in names for name in recorder.operator_codes], dtype=bool))
+        return available
+
+    def available_by_step(steps, time):
+        available = original_available_by_step(steps, time)
+        recorder._batch_candidates = {step.name: row.copy() for step, row in zip(steps, available)}
+        return available
+
+    def update_log(task, time, *arguments):
+        recorder._popping = []
+        try:
+            return originals["update_log"](task, time, *arguments)
+        finally:
+            recorder.decision(task, time, recorder._popping)
+            recorder._popping = None
+
+    def pop_ready(log, time):
+        index = original_pop_ready(log, time)
+        if recorder._popping is not None:
+            recorder._popping.append(-1 if index is None else index)
+        return index
+
+    recorder._next_observer = simulation.assignments.observer
+    simulation.assignments.observer = recorder
+    simulation_engine.ready_tasks = ready_tasks
+    simulation_engine.tasks_by_priority = legacy_tasks_by_priority
+    simulation_engine.get_available_operators = get_available_operators
+    simulation_engine.update_log = update_log
+    simulation.operators_index.available_by_step = available_by_step
+    StepLog.pop_ready = pop_ready
+    try:
+        yield recorder
+    finally:
+        for name, function in originals.items():
+            setattr(simulation_engine, name, function)
+        StepLog.pop_ready = original_pop_ready
+        del simulation.operators_index.available_by_step
+        simulation.assignments.observer = recorder._next_observer
+
+
+def save_trace(trace: GoldenTrace, path: str) -> None:
+    arrays = {"query_clocks": trace.query_clocks, "snapshot_lengths": trace.snapshot_lengths,
+              "snapshot_open": trace.snapshot_open, "decision_queries": trace.decision_queries,
+              "decision_times": trace.decision_times, "decision_steps": trace.decision_steps,
+              "operators_a": trace.operators_a, "operators_b": trace.operators_b,
+              "candidates": np.packbits(trace.candidates, axis=1), "entered": trace.entered}
+    arrays["ready_steps"], arrays["ready_offsets"] = flatten(trace.ready_steps, np.int16)
+    arrays["popped"], arrays["popped_offsets"] = flatten(trace.popped, np.int64)
+    arrays["metadata"] = np.array(json.dumps(trace.metadata))
+    with open(path, "wb") as file:
+        np.savez_compressed(file, **arrays)
+
+
+def load_trace(path: str) -> GoldenTrace:
+    with np.load(path) as archive:
+        metadata = json.loads(str(archive["metadata"]))
+        if metadata["format"] != TRACE_FORMAT:
+            raise ValueError(f"Trace {path} has the format {metadata['format']}, expected {TRACE_FORMAT}")
+        candidates = np.unpackbits(archive["candidates"], axis=1, count=len(metadata["operators"])).astype(bool)
+        return GoldenTrace(metadata, archive["query_clocks"], unflatten(archive["ready_steps"], archive["ready_offsets"]),
+                           archive["snapshot_lengths"], archive["snapshot_open"], archive["decision_queries"],
+                           archive["decision_times"], archive["decision_steps"], archive["operators_a"],
+                           archive["operators_b"], candidates, archive["entered"],
+                           unflatten(archive["popped"], archive["popped_offsets"]))
+
+
+# Index of the first row that differs between two sequences of rows, None if they are the same
+def first_difference(expected: list, actual: list):
+    for index, (expected_row, actual_row) in enumerate(zip(expected, actual)):
+        if not np.array_equal(expected_row, actual_row):
+            return index
+    return None if len(expected) == len(actual) else min(len(expected), len(actual))
+
+
+def describe_row(rows: list, index: int, describe):
+    return describe(rows[index]) if index < len(rows) else "nothing"
+
+
+# First difference between the expected and the actual traces, in the order of the run, None if they are the same
+def first_divergence(expected: GoldenTrace, actual: GoldenTrace):
+    if expected.steps != actual.steps or expected.operators != actual.operators:
+        return Divergence("inputs", 0, None, (expected.steps, expected.operators), (actual.steps, actual.operators))
+
+    def clock(trace: GoldenTrace, index: int, of_decision: bool):
+        times = trace.decision_times if of_decision else trace.query_clocks
+        return str(np.datetime64(int(times[index]), "ns")) if index < len(times) else "end of the run"
+
+    def step_names(codes) -> list:
+        return [expected.steps[code] for code in codes]
+
+    def operator_names(mask) -> list:
+        return [name for name, candidate in zip(expected.operators, mask) if candidate]
+
+    queries = [("clock", lambda trace: list(trace.query_clocks), lambda value: str(np.datetime64(int(value), "ns"))),
+               ("ready_tasks", lambda trace: trace.ready_steps, step_names),
+               ("log snapshot", lambda trace: list(np.stack([trace.snapshot_lengths, trace.snapshot_open], axis=1)),
+                lambda value: {step: (int(entered), int(still_in)) for step, entered, still_in in zip(expected.steps, *value)})]
+    decisions = [("task", lambda trace: list(zip(trace.decision_queries, trace.decision_times, trace.decision_steps)),
+                  lambda value: {"query": int(value[0]), "time": str(np.datetime64(int(value[1]), "ns")),
+                                 "step": expected.steps[value[2]]}),
+                 ("candidate operators", lambda trace: list(trace.candidates), operator_names),
+                 ("chosen pair", lambda trace: list(zip(trace.operators_a, trace.operators_b)),
+                  lambda value: tuple(expected.operators[code] if code >= 0 else None for code in value)),
+                 ("log update", lambda trace: [np.concatenate(([entered], popped)) for entered, popped in
+                                               zip(trace.entered, trace.popped)],
+                  lambda value: {"entered": int(value[0]), "taken from the previous steps": [int(index) for index in value[1:]]})]
+
+    divergences = []
+    for entries, of_decision in ((queries, False), (decisions, True)):
+        for kind, rows, describe in entries:
+            expected_rows, actual_rows = rows(expected), rows(actual)
+            index = first_difference(expected_rows, actual_rows)
+            if index is not None:
+                # A decision comes right after the query it is taken from
+                order = (int(expected.decision_queries[index]) if index < len(expected.decision_queries) else np.inf,
+                         1) if of_decision else (index, 0)
+                divergences.append((order, Divergence(f"{'decision' if of_decision else 'query'} {kind}", index,
+                                                      clock(expected, index, of_decision),
+                                                      describe_row(expected_rows, index, describe),
+                                                      describe_row(actual_rows, index, describe))))
+    return min(divergences, key=lambda divergence: divergence[0])[1] if divergences else None
+
+
+# readiness of the simulation answered by a full scan of the steps, to compare the incremental tracker with it
+class FullScan:
+
+    def __init__(self, Chronologically_Ordered_Steps: dict):
+        self.steps = Chronologically_Ordered_Steps
+
+    def entered(self, step, time) -> None:
+        pass
+
+    def tasks(self, time) -> list:
+        return tasks_by_priority(time, self.steps)
+
+
+def run_full_scan(simulation: Simulation, modules_to_do: int):
+    simulation.readiness = FullScan(simulation.steps)
+    return simulation.run(modules_to_do)
+
+
+# Event driven loop in the bounded memory mode, the finished rows being retired after each module that leaves a step
+def run_bounded(simulation: Simulation, modules_to_do: int):
+    with tempfile.TemporaryDirectory() as directory:
+        simulation.history_directory = directory
+        simulation.attach_history(batch=1)
+        return simulation.run(modules_to_do)
+
+
+# The code paths that must give the same schedules, the historical hour stepping loop being the reference
+CODE_PATHS: dict = {
+    "hour_stepping": lambda simulation, modules_to_do: simulation.run_hour_stepping(modules_to_do),
+    "event_driven": lambda simulation, modules_to_do: simulation.run(modules_to_do),
+    "full_scan": run_full_scan,
+    "bounded": run_bounded,
+}
+
+
+def record(data: dict, inventory, modules_to_do: int, seed: int = 0, path: str = "event_driven") -> GoldenTrace:
+    simulation = Simulation(data, inventory, seed)
+    with recording(simulation) as recorder:
+        CODE_PATHS[path](simulation, modules_to_do)
+    return recorder.trace()
+
+
+# Runs the code path on the inputs and seed of the golden trace and returns the first divergence, None if there is none
+def replay(golden: GoldenTrace, data: dict, inventory, modules_to_do: int, path: str = "event_driven"):
+    if golden.metadata["inputs_hash"] != inputs_hash(data, inventory):
+        raise ValueError("The golden trace was recorded from other inputs")
+    return first_divergence(golden, record(data, inventory, modules_to_do, golden.metadata["seed"], path))
+
+
+# Runs the reference and candidate code paths side by side on the generated scenarios (see benchmark.generate_scenario)
+# and returns, for each scenario, its parameters and the first divergence (None if the traces are the same)
+def differential(data: dict, inventory, scenarios: list, reference: str = "hour_stepping",
+                 candidate: str = "event_driven", seed: int = 0) -> list:
+    results = []
+    for scenario in scenarios:
+        scenario_data, scenario_inventory = generate_scenario(data, inventory, seed=seed, **scenario)
+        expected = record(scenario_data, scenario_inventory, scenario["modules"], seed, reference)
+        actual = record(scenario_data, scenario_inventory, scenario["modules"], seed, candidate)
+        results.append((scenario, first_divergence(expected, actual)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Golden traces of the decisions of the simulation")
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Record the golden trace of a run")
+    record_parser.add_argument("modules", type=int)
+    record_parser.add_argument("--output", default="golden_trace.npz")
+    record_parser.add_argument("--path", choices=list(CODE_PATHS), default="hour_stepping")
+
+    replay_parser = commands.add_parser("replay", help="Compare a run with a golden trace")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("modules", type=int)
+    replay_parser.add_argument("--path", choices=list(CODE_PATHS), default="event_driven")
+
+    diff_parser = commands.add_parser("diff", help="Compare two code paths on generated scenarios")
+    diff_parser.add_argument("--reference", choices=list(CODE_PATHS), default="hour_stepping")
+    diff_parser.add_argument("--candidate", choices=list(CODE_PATHS), default="event_driven")
+    for parameter, values in DEFAULT_SUITE.items():
+        kind = float if parameter == "holiday_density" else int
+        diff_parser.add_argument(f"--{parameter.replace('_', '-')}", type=kind, nargs="+", default=[BASE_SCENARIO[parameter]])
+    arguments = parser.parse_args()
+
+    data, inventory = load_config(arguments.config), load_inventory(arguments.inventory)
+    if arguments.command == "record":
+        trace = record(data, inventory, arguments.modules, arguments.seed, arguments.path)
+        save_trace(trace, arguments.output)
+        print(f"{len(trace.decision_times)} decisions written to {arguments.output}")
+    elif arguments.command == "replay":
+        divergence = replay(load_trace(arguments.trace), data, inventory, arguments.modules, arguments.path)
+        print(divergence or "Same decisions as the golden trace")
+    else:
+        suite = {parameter: getattr(arguments, parameter) for parameter in DEFAULT_SUITE}
+        for scenario, divergence in differential(data, inventory, suite_scenarios(suite), arguments.reference,
+                                                 arguments.candidate, arguments.seed):
+            print(f"{scenario}: {divergence or 'same decisions'}")
+
+
+if __name__ == "__main__":
+    main()
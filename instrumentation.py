@@ -0,0 +1,100 @@
+import argparse
+import cProfile
+import json
+import pstats
+import time as clock
+from contextlib import contextmanager, nullcontext
+
+from common import load_config
+from TasksHierarchy import load_inventory
+
+# Opt-in instrumentation of the simulation loop. A Trace given to the Simulation collects:
+#   - counters: main loop iterations, idle jumps of the clock and the ticks they skip, tasks, scans of the availability
+#     of the candidate operators (and the number of operators checked), openings visited while searching the next
+#     time at which a task can be done, reservations, "There is a big issue !!" fallbacks of update_log...
+#   - timers: cumulated wall time of each phase of the loop,
+#   - when a path is given, a structured trace file (one JSON object per line): one record per task and per idle jump,
+#     and a summary record with the counters and timers at the end of each run.
+# Without a Trace the loop only pays for `is not None` checks and empty context managers.
+
+NO_PHASE = nullcontext()
+
+
+class Trace:
+
+    def __init__(self, path=None):
+        self.counters: dict = {}
+        self.timers: dict = {}
+        self.path = path
+        self._file = open(path, "w") if path is not None else None
+
+    def count(self, name: str, number: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + number
+
+    @contextmanager
+    def phase(self, name: str):
+        begin = clock.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + clock.perf_counter() - begin
+
+    # Writes a record in the trace file, if there is one
+    def record(self, kind: str, **fields) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps({"kind": kind} | fields, default=str) + "\n")
+
+    def summary(self) -> dict:
+        return {"counters": dict(self.counters), "timers": dict(self.timers)}
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Timer of a phase of the loop, that costs nothing when there is no trace
+def phase(trace, name: str):
+    return NO_PHASE if trace is None else trace.phase(name)
+
+
+# Profiles the code run inside the block with cProfile. The statistics are saved to path (readable with pstats or
+# snakeviz) and the most expensive functions are printed.
+@contextmanager
+def profiled(path=None, top: int = 20):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        if top:
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+
+
+def main():
+    from simulation import Simulation
+
+    parser = argparse.ArgumentParser(description="Instrumented run of the production simulation")
+    parser.add_argument("modules", type=int, help="Number of modules to simulate")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    parser.add_argument("--trace", default="trace.jsonl", help="Structured trace file (JSON lines)")
+    parser.add_argument("--profile", default=None, help="Profiles the run with cProfile and saves the statistics here")
+    arguments = parser.parse_args()
+
+    trace = Trace(arguments.trace)
+    simulation = Simulation(load_config(arguments.config), load_inventory(arguments.inventory), arguments.seed,
+                            trace=trace)
+    with profiled(arguments.profile) if arguments.profile is not None else nullcontext():
+        simulation.run(arguments.modules)
+    trace.close()
+
+    print(json.dumps(trace.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
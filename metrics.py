@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from common import SHIPMENT_STEP
+from step_log import to_ns
+
+# Production metrics kept up to date while the simulation runs, in numpy counters binned by time (one column per period
+# of `resolution` since the start of the simulation):
+#   - WIP per stage (modules entered minus modules that left the steps of the stage, the shipped modules excluded),
+#   - modules shipped (entries in SHIPMENT_STEP),
+#   - busy time of each operator,
+#   - queue waits per step: time spent by the modules ready in the previous steps before being taken by the step, and
+#     the number of modules taken.
+# Each module moved and each assignment only updates a few cells, so the charts of throughput, WIP and workload read the
+# series directly instead of rescanning the logs. The series can be read at any multiple of the resolution.
+DEFAULT_RESOLUTION: timedelta = timedelta(hours=1)
+
+
+# Total time of the intervals [begins, ends) (in ns) falling in each bin of the edges, by difference of the cumulated
+# busy time at the edges
+def spread_intervals(begins: np.ndarray, ends: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    def cumulated(dates: np.ndarray) -> np.ndarray:
+        dates = np.sort(dates)
+        counts = np.searchsorted(dates, edges, side="left")
+        sums = np.concatenate(([0], np.cumsum(dates)))[counts]
+        return counts * edges - sums  # Sum over the dates before each edge of (edge - date)
+    return np.diff(cumulated(begins) - cumulated(ends))
+
+
+class ProductionMetrics:
+
+    def __init__(self, stage_of: dict, operator_names: list, start: datetime, resolution: timedelta = DEFAULT_RESOLUTION,
+                 initial_bins: int = 1024):
+        self.step_names: list = list(stage_of)
+        self.stage_names: list = list(dict.fromkeys(stage_of.values()))
+        self.operator_names: list = list(operator_names)
+        self._step_rows: dict = {name: row for row, name in enumerate(self.step_names)}
+        self._stage_rows: dict = {step: self.stage_names.index(stage) for step, stage in stage_of.items()}
+        self._operator_rows: dict = {name: row for row, name in enumerate(self.operator_names)}
+
+        self.start: datetime = start
+        self.resolution: timedelta = resolution
+        self._start_ns: int = to_ns(start)
+        self._resolution_ns: int = int(resolution.total_seconds() * 10 ** 9)
+        self._length: int = 1  # Number of bins up to the current time of the simulation
+
+        self._wip_changes: np.ndarray = np.zeros((len(self.stage_names), initial_bins), dtype=np.int64)
+        self._shipped: np.ndarray = np.zeros(initial_bins, dtype=np.int64)
+        self._busy_ns: np.ndarray = np.zeros((len(self.operator_names), initial_bins), dtype=np.int64)
+        self._wait_ns: np.ndarray = np.zeros((len(self.step_names), initial_bins), dtype=np.int64)
+        self._waits: np.ndarray = np.zeros((len(self.step_names), initial_bins), dtype=np.int64)
+
+    # Metrics of the current state of a simulation, rebuilt from its step logs and assignments (at the start of a run,
+    # or after loading a checkpoint). The following updates are incremental.
+    @classmethod
+    def from_simulation(cls, simulation, resolution: timedelta = DEFAULT_RESOLUTION):
+        stage_of = {step["Step"]: step["Stage"] for step in simulation.data["StagesAndSteps"]}
+        metrics = cls(stage_of, simulation.operators_index.operator_names, simulation.simulation_start, resolution)
+        metrics.advance(simulation.time)
+
+        for step in simulation.steps.values():
+            entries, exits = step.log.entry_dates, step.log.exit_dates
+            if step.name == SHIPMENT_STEP:
+                metrics._count("_shipped", None, entries)
+            else:
+                stage_row = metrics._stage_rows[step.name]
+                metrics._count("_wip_changes", stage_row, entries)
+                metrics._count("_wip_changes", stage_row, exits[~np.isnat(exits)], -1)
+
+            if step.previous_steps[0] is None:
+                continue
+            step_row = metrics._step_rows[step.name]
+            for previous_step in step.previous_steps:  # Each step is the only next step of its previous steps
+                log = previous_step.log
+                left = ~np.isnat(log.exit_dates)
+                ready_dates = log.entry_dates[left] + np.timedelta64(previous_step.duration)
+                exit_dates = log.exit_dates[left]
+                waits = np.maximum(exit_dates - ready_dates, np.timedelta64(0, "ns")).astype(np.int64)
+                metrics._count("_wait_ns", step_row, exit_dates, waits)
+                metrics._count("_waits", step_row, exit_dates)
+
+        records = simulation.assignments.records()
+        if len(records):
+            metrics._grow(int(metrics._bins(records["end"].astype(np.int64)).max()) + 1)
+            edges = metrics._start_ns + np.arange(metrics._busy_ns.shape[1] + 1, dtype=np.int64) * metrics._resolution_ns
+            edges[0] = np.iinfo(np.int64).min // 2  # The work done before the start is counted in the first bin
+            for operator_row in range(len(metrics.operator_names)):
+                mine = (records["operator_a"] == operator_row) | (records["operator_b"] == operator_row)
+                metrics._busy_ns[operator_row] += spread_intervals(records["time"][mine].astype(np.int64),
+                                                                   records["end"][mine].astype(np.int64), edges)
+        return metrics
+
+    # Series up to the current time (arrays) and what is needed to read them again (JSON compatible), e.g. to cache the
+    # metrics of a finished simulation
+    def state(self) -> tuple:
+        arrays = {name: getattr(self, f"_{name}")[..., :self._length]
+                  for name in ("wip_changes", "shipped", "busy_ns", "wait_ns", "waits")}
+        metadata = {"stage_of": {step: self.stage_names[self._stage_rows[step]] for step in self.step_names},
+                    "operators": self.operator_names, "start": self.start.isoformat(),
+                    "resolution_seconds": self.resolution.total_seconds()}
+        return metadata, arrays
+
+    @classmethod
+    def restore(cls, metadata: dict, arrays: dict):
+        metrics = cls(metadata["stage_of"], metadata["operators"], datetime.fromisoformat(metadata["start"]),
+                      timedelta(seconds=metadata["resolution_seconds"]), initial_bins=len(arrays["shipped"]))
+        for name in ("wip_changes", "shipped", "busy_ns", "wait_ns", "waits"):
+            setattr(metrics, f"_{name}", np.array(arrays[name], dtype=np.int64))
+        metrics._length = len(arrays["shipped"])
+        return metrics
+
+    # Bin of each date (in ns), the dates before the start falling in the first bin
+    def _bins(self, dates_ns):
+        return np.maximum((np.asarray(dates_ns, dtype=np.int64) - self._start_ns) // self._resolution_ns, 0)
+
+    # Adds the values to the bins of the dates in a row of one of the series (None for the 1D series)
+    def _count(self, series: str, row, dates: np.ndarray, values=1) -> None:
+        if len(dates) == 0:
+            return
+        bins = self._bins(dates.astype("datetime64[ns]").astype(np.int64))
+        self._grow(int(bins.max()) + 1)
+        np.add.at(getattr(self, series) if row is None else getattr(self, series)[row], bins, values)
+
+    def _bin(self, time) -> int:
+        bin_index = max((to_ns(time) - self._start_ns) // self._resolution_ns, 0)
+        self._grow(bin_index + 1)
+        return bin_index
+
+    def _grow(self, length: int) -> None:
+        capacity = self._shipped.shape[0]
+        if length > capacity:
+            extra = max(length, 2 * capacity) - capacity
+            self._wip_changes = np.pad(self._wip_changes, ((0, 0), (0, extra)))
+            self._shipped = np.pad(self._shipped, (0, extra))
+            self._busy_ns = np.pad(self._busy_ns, ((0, 0), (0, extra)))
+            self._wait_ns = np.pad(self._wait_ns, ((0, 0), (0, extra)))
+            self._waits = np.pad(self._waits, ((0, 0), (0, extra)))
+
+    # The series cover the periods up to the given time
+    def advance(self, time) -> None:
+        self._length = max(self._length, self._bin(time) + 1)
+
+    # Modules entering a step (moved from the previous steps, or delivered)
+    def enter(self, step_name: str, time, quantity: int = 1) -> None:
+        bin_index = self._bin(time)
+        if step_name == SHIPMENT_STEP:
+            self._shipped[bin_index] += quantity
+        else:
+            self._wip_changes[self._stage_rows[step_name], bin_index] += quantity
+
+    # A module ready since ready_date leaving a step, taken by the next step at the given time
+    def leave(self, step_name: str, ready_date, time, next_step_name: str) -> None:
+        bin_index = self._bin(time)
+        self._wip_changes[self._stage_rows[step_name], bin_index] -= 1
+        next_row = self._step_rows[next_step_name]
+        self._wait_ns[next_row, bin_index] += max(to_ns(time) - to_ns(ready_date), 0)
+        self._waits[next_row, bin_index] += 1
+
+    # Both operators of an assignment are busy during [time, end)
+    def assign(self, time, end, operator_a: str, operator_b: str) -> None:
+        begin_ns, end_ns = to_ns(time), to_ns(end)
+        first_bin, last_bin = self._bin(time), self._bin(end)
+        for bin_index in range(first_bin, last_bin + 1):
+            bin_begin = self._start_ns + bin_index * self._resolution_ns
+            overlap = min(end_ns, bin_begin + self._resolution_ns) - max(begin_ns, bin_begin)
+            if overlap > 0:
+                self._busy_ns[self._operator_rows[operator_a], bin_index] += overlap
+                self._busy_ns[self._operator_rows[operator_b], bin_index] += overlap
+
+    # Sums the bins by groups of resolution / self.resolution
+    def _resample(self, series: np.ndarray, resolution) -> np.ndarray:
+        series = series[..., :self._length]
+        if resolution is None or resolution == self.resolution:
+            return series
+        factor, remainder = divmod(resolution, self.resolution)
+        if remainder or factor < 1:
+            raise ValueError(f"The resolution must be a multiple of {self.resolution}")
+        padding = -series.shape[-1] % factor
+        series = np.pad(series, [(0, 0)] * (series.ndim - 1) + [(0, padding)])
+        return series.reshape(series.shape[:-1] + (-1, factor)).sum(axis=-1)
+
+    # Beginning of each period of the series
+    def times(self, resolution=None) -> np.ndarray:
+        step = self.resolution if resolution is None else resolution
+        count = self._resample(self._shipped, resolution).shape[-1]
+        return np.datetime64(self.start, "ns") + np.arange(count) * np.timedelta64(step)
+
+    # Number of modules in each stage at the end of each period (stages x periods, in the order of stage_names)
+    def wip(self, resolution=None) -> np.ndarray:
+        return np.cumsum(self._resample(self._wip_changes, resolution), axis=-1)
+
+    # Modules shipped during each period, and in total at the end of each period
+    def throughput(self, resolution=None) -> np.ndarray:
+        return self._resample(self._shipped, resolution)
+
+    def shipped(self, resolution=None) -> np.ndarray:
+        return np.cumsum(self.throughput(resolution))
+
+    # Minutes of work of each operator in each period (operators x periods, in the order of operator_names)
+    def busy_minutes(self, resolution=None) -> np.ndarray:
+        return self._resample(self._busy_ns, resolution) / 6e10
+
+    # Hours waited in total by the modules taken by each step during each period, and number of those modules
+    # (steps x periods, in the order of step_names)
+    def queue_wait_hours(self, resolution=None) -> np.ndarray:
+        return self._resample(self._wait_ns, resolution) / 3.6e12
+
+    def queue_counts(self, resolution=None) -> np.ndarray:
+        return self._resample(self._waits, resolution)
+
+    # All the series in one long DataFrame (time, metric, name, value), e.g. for plotting
+    def to_frame(self, resolution=None) -> pd.DataFrame:
+        times = self.times(resolution)
+        frames = [pd.DataFrame({"time": times, "metric": "shipped", "name": SHIPMENT_STEP,
+                                "value": self.shipped(resolution)})]
+        for metric, names, series in (("wip", self.stage_names, self.wip(resolution)),
+                                      ("busy_minutes", self.operator_names, self.busy_minutes(resolution)),
+                                      ("queue_wait_hours", self.step_names, self.queue_wait_hours(resolution))):
+            frames.append(pd.DataFrame({"time": np.tile(times, len(names)), "metric": metric,
+                                        "name": np.repeat(names, len(times)), "value": series.ravel()}))
+        return pd.concat(frames, ignore_index=True)
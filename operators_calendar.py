@@ -0,0 +1,111 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from step_log import to_ns
+
+DAY_NS: int = 24 * 3600 * 10 ** 9
+WEEKDAYS: tuple = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+def to_datetime(time_ns: int) -> datetime:
+    return pd.Timestamp(int(time_ns)).to_pydatetime()
+
+
+# Converts the "HH:MM:SS" boundaries of a daily shift to (begin, end) offsets in ns from midnight
+def shift_offsets(daily_shift: dict) -> list:
+    boundaries = [int(pd.Timedelta(hour).value) for hour in daily_shift.values()]
+    # Implicitly we assume that there is an even number of time constraints (namely the beginning and the ending of the time slot)
+    return list(zip(boundaries[::2], boundaries[1::2]))
+
+
+# Days (as midnight ns) of [first_day, last_day] that are not covered by the holidays.
+# The holidays are given as days, the end day being excluded.
+def working_days(first_day: int, last_day: int, holidays: list) -> np.ndarray:
+    days = np.arange(first_day, last_day + DAY_NS, DAY_NS, dtype=np.int64)
+    off = np.zeros(len(days), dtype=bool)
+    for begin, end in holidays:
+        off |= (days >= to_ns(begin)) & (days < to_ns(end))
+    return days[~off]
+
+
+# Shift calendar of all the operators over the whole simulation, compiled once per run.
+# For each operator the slots of work are stored in two sorted arrays (beginnings and endings, in ns), the lab openings
+# are the sorted beginnings of the slots of all the operators. All the queries are then bisections in those arrays.
+class OperatorsCalendar:
+
+    def __init__(self, operator_names: list, begins: list, ends: list):
+        self.operator_names: list = operator_names
+        self.begins: list = begins
+        self.ends: list = ends
+        self.openings: np.ndarray = np.unique(np.concatenate(begins)) if begins else np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def compile(cls, data: dict, start: datetime, end: datetime):
+        first_day = to_ns(pd.Timestamp(start).normalize())
+        last_day = to_ns(pd.Timestamp(end).normalize())
+        CERN_holidays = [(datetime.fromisoformat(first), datetime.fromisoformat(last)) for first, last in data["CERNHolidays"]]
+
+        operator_names, begins, ends = [], [], []
+        for id, operator in enumerate(data["Operators"]):
+            name = f"Operator{id + 1}"
+            holidays = CERN_holidays + [(datetime.fromisoformat(first), datetime.fromisoformat(last))
+                                        for first, last in data["OperatorHolidays"][name]]
+            days = working_days(first_day, last_day, holidays)
+            weekdays = (days // DAY_NS + 3) % 7  # The 1st of January 1970 was a Thursday
+
+            operator_begins, operator_ends = [], []
+            for weekday, daily_shift in data["OperatorWorkHours"][name].items():
+                if WEEKDAYS.index(weekday) >= 5:  # The lab is closed during the weekends
+                    continue
+                days_of_week = days[weekdays == WEEKDAYS.index(weekday)]
+                for shift_begin, shift_end in shift_offsets(daily_shift):
+                    operator_begins.append(days_of_week + shift_begin)
+                    operator_ends.append(days_of_week + shift_end)
+
+            operator_begins = np.concatenate(operator_begins) if operator_begins else np.empty(0, dtype=np.int64)
+            operator_ends = np.concatenate(operator_ends) if operator_ends else np.empty(0, dtype=np.int64)
+            order = np.argsort(operator_begins, kind="stable")
+            operator_names.append(name)
+            begins.append(operator_begins[order])
+            ends.append(operator_ends[order])
+
+        return cls(operator_names, begins, ends)
+
+    # Slot (begin, end) of the operator containing the given time, None if the operator is not working at that time
+    def slot_containing(self, operator_index: int, time_ns: int):
+        position = np.searchsorted(self.begins[operator_index], time_ns, side="right") - 1
+        if position >= 0 and time_ns < self.ends[operator_index][position]:
+            return int(self.begins[operator_index][position]), int(self.ends[operator_index][position])
+        return None
+
+    # For each operator, True if one of their slots covers the whole [begin, end) period
+    def on_shift(self, begin, end) -> np.ndarray:
+        begin_ns, end_ns = to_ns(begin), to_ns(end)
+        available = np.zeros(len(self.operator_names), dtype=bool)
+        for operator_index in range(len(self.operator_names)):
+            slot = self.slot_containing(operator_index, begin_ns)
+            available[operator_index] = slot is not None and end_ns <= slot[1]
+        return available
+
+    # First time strictly after the given time at which a slot of one of the operators begins, None after the horizon
+    def next_opening_after(self, time):
+        position = np.searchsorted(self.openings, to_ns(time), side="right")
+        if position < len(self.openings):
+            return to_datetime(self.openings[position])
+        return None
+
+    # Slots of the operator during the day of the given time
+    def day_slots(self, operator_index: int, day) -> list:
+        midnight = to_ns(pd.Timestamp(day).normalize())
+        first = np.searchsorted(self.begins[operator_index], midnight, side="left")
+        last = np.searchsorted(self.begins[operator_index], midnight + DAY_NS, side="left")
+        return [(to_datetime(begin), to_datetime(end)) for begin, end in
+                zip(self.begins[operator_index][first:last], self.ends[operator_index][first:last])]
+
+    # Set of the lab hours slots (the union of the slots of all the operators) containing the given time
+    def lab_periods_containing(self, time) -> set:
+        time_ns = to_ns(time)
+        periods = (self.slot_containing(operator_index, time_ns) for operator_index in range(len(self.operator_names)))
+        return {period for period in periods if period is not None}
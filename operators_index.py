@@ -0,0 +1,169 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from operators_calendar import OperatorsCalendar, to_datetime
+from step_log import to_ns
+
+SECOND_NS: int = 10 ** 9
+
+
+# Occupancy index of the operators, answering "which qualified operators are free during [t, t + required)" in one
+# vectorized call:
+#   - skills is a boolean matrix operators x steps,
+#   - the shift slots of the calendar are flattened in arrays sorted by (operator, begin), so that one searchsorted
+#     on composite keys (operator * stride + time) finds the current slot of every operator at once,
+#   - the reservations of each operator are kept in small sorted lists, that can be pruned as the clock moves forward.
+# Inside the index the times are integer seconds since the first day of the calendar.
+class OperatorsIndex:
+
+    def __init__(self, calendar: OperatorsCalendar, operators_skills: list, step_names: list):
+        self.operator_names: list = list(calendar.operator_names)
+        self.operator_indices: dict = {name: index for index, name in enumerate(self.operator_names)}
+        self.step_indices: dict = {name: index for index, name in enumerate(step_names)}
+
+        if isinstance(operators_skills, np.ndarray):  # Skill matrix already compiled (see compiled_scenario)
+            self.skills: np.ndarray = operators_skills.astype(bool)
+        else:
+            self.skills: np.ndarray = np.zeros((len(self.operator_names), len(step_names)), dtype=bool)
+            for operator_index, skills in enumerate(operators_skills):
+                for skill in skills:
+                    if skill in self.step_indices:
+                        self.skills[operator_index, self.step_indices[skill]] = True
+
+        all_begins = np.concatenate(calendar.begins) if calendar.begins else np.empty(0, dtype=np.int64)
+        self.origin: int = int(all_begins.min()) if len(all_begins) else 0
+        all_ends = np.concatenate(calendar.ends) if calendar.ends else np.empty(0, dtype=np.int64)
+        self.stride: int = (int(all_ends.max()) - self.origin) // SECOND_NS + 2 if len(all_ends) else 2
+
+        operator_ids = np.concatenate([np.full(len(begins), operator_index, dtype=np.int64)
+                                       for operator_index, begins in enumerate(calendar.begins)]) if calendar.begins else np.empty(0, dtype=np.int64)
+        self.slot_begins: np.ndarray = (all_begins - self.origin) // SECOND_NS
+        self.slot_ends: np.ndarray = (all_ends - self.origin) // SECOND_NS
+        self.slot_keys: np.ndarray = operator_ids * self.stride + self.slot_begins
+        self.slot_operators: np.ndarray = operator_ids
+
+        self.busy_begins: list = [[] for _ in self.operator_names]
+        self.busy_ends: list = [[] for _ in self.operator_names]
+        self.trace = None  # Optional instrumentation.Trace counting the scans, openings and reservations
+
+    def _to_seconds(self, time) -> int:
+        return (to_ns(time) - self.origin) // SECOND_NS
+
+    def _to_datetime(self, seconds: int) -> datetime:
+        return to_datetime(self.origin + int(seconds) * SECOND_NS)
+
+    # The times out of the calendar are clipped so that the keys of an operator never overlap with their neighbours'
+    def _operator_keys(self, seconds: int) -> np.ndarray:
+        return np.arange(len(self.operator_names), dtype=np.int64) * self.stride + min(max(seconds, -1), self.stride - 1)
+
+    def qualified(self, step_name: str) -> np.ndarray:
+        return self.skills[:, self.step_indices[step_name]]
+
+    # For each operator, True if a slot of the calendar covers the whole [begin, end) period (in seconds)
+    def _on_shift(self, begin: int, end: int) -> np.ndarray:
+        if len(self.slot_keys) == 0:
+            return np.zeros(len(self.operator_names), dtype=bool)
+        positions = np.searchsorted(self.slot_keys, self._operator_keys(begin), side="right") - 1
+        valid = positions >= 0
+        positions = np.maximum(positions, 0)
+        same_operator = self.slot_operators[positions] == np.arange(len(self.operator_names))
+        return valid & same_operator & (self.slot_ends[positions] >= end)
+
+    def _is_busy(self, operator_index: int, begin: int, end: int) -> bool:
+        position = bisect_left(self.busy_begins[operator_index], end) - 1  # Last reservation starting before the end
+        return position >= 0 and self.busy_ends[operator_index][position] > begin
+
+    def _available(self, qualified: np.ndarray, begin: int, end: int) -> np.ndarray:
+        mask = qualified & self._on_shift(begin, end)
+        if self.trace is not None:
+            self.trace.count("availability_scans")
+            self.trace.count("candidate_operators", int(mask.sum()))
+        for operator_index in np.flatnonzero(mask):
+            if self.busy_begins[operator_index] and self._is_busy(operator_index, begin, end):
+                mask[operator_index] = False
+        return mask
+
+    # Mask of the operators qualified for the step, on shift and not reserved during the whole [time, time + required)
+    def available(self, step_name: str, time, required: timedelta) -> np.ndarray:
+        begin = self._to_seconds(time)
+        return self._available(self.qualified(step_name), begin, begin + int(required.total_seconds()))
+
+    # Availability masks of several steps at the same time, one row per step name (in the given order)
+    def available_by_step(self, steps: list, time) -> np.ndarray:
+        begin = self._to_seconds(time)
+        return np.array([self._available(self.qualified(step.name), begin, begin + int(step.required.total_seconds()))
+                         for step in steps], dtype=bool).reshape(len(steps), len(self.operator_names))
+
+    # First end of a reservation strictly after the given time, None if there is none
+    def next_release_after(self, time):
+        seconds = self._to_seconds(time)
+        candidates = []
+        for ends in self.busy_ends:
+            position = bisect_right(ends, seconds)
+            if position < len(ends):
+                candidates.append(ends[position])
+        return self._to_datetime(min(candidates)) if candidates else None
+
+    # Next time strictly after the given one (in seconds) at which one of the operators of the mask may become free:
+    # the beginning of one of their slots or the end of one of their reservations
+    def _next_opening(self, seconds: int, operators_mask: np.ndarray):
+        candidates = []
+        if len(self.slot_keys):
+            positions = np.searchsorted(self.slot_keys, self._operator_keys(seconds), side="right")
+            positions = np.minimum(positions, len(self.slot_keys) - 1)
+            has_next = operators_mask & (self.slot_operators[positions] == np.arange(len(self.operator_names))) \
+                       & (self.slot_begins[positions] > seconds)
+            candidates = [int(begin) for begin in self.slot_begins[positions][has_next]]
+        for operator_index in np.flatnonzero(operators_mask):
+            position = bisect_right(self.busy_ends[operator_index], seconds)
+            if position < len(self.busy_ends[operator_index]):
+                candidates.append(self.busy_ends[operator_index][position])
+        return min(candidates) if candidates else None
+
+    # Earliest time, from the given one, at which at least two qualified operators are free for the whole step.
+    # None if it never happens before the end of the calendar.
+    def earliest_pair_time(self, step_name: str, time, required: timedelta):
+        qualified = self.qualified(step_name)
+        if qualified.sum() < 2:
+            return None
+        seconds = self._to_seconds(time)
+        required_seconds = int(required.total_seconds())
+        while self._available(qualified, seconds, seconds + required_seconds).sum() < 2:
+            seconds = self._next_opening(seconds, qualified)
+            if self.trace is not None:
+                self.trace.count("openings_visited")
+            if seconds is None:
+                return None
+        return time if seconds == self._to_seconds(time) else self._to_datetime(seconds)
+
+    # The reservations of an operator never overlap, so they stay sorted both by beginning and by end
+    def reserve(self, operator_index: int, begin, end) -> None:
+        begin, end = self._to_seconds(begin), self._to_seconds(end)
+        if self.trace is not None:
+            self.trace.count("reservations")
+        position = bisect_left(self.busy_begins[operator_index], begin)
+        self.busy_begins[operator_index].insert(position, begin)
+        self.busy_ends[operator_index].insert(position, end)
+
+    def release(self, operator_index: int, begin) -> None:
+        begin = self._to_seconds(begin)
+        position = bisect_left(self.busy_begins[operator_index], begin)
+        if position < len(self.busy_begins[operator_index]) and self.busy_begins[operator_index][position] == begin:
+            del self.busy_begins[operator_index][position]
+            del self.busy_ends[operator_index][position]
+
+    # Forgets all the reservations, to replay the simulation from the beginning
+    def clear(self) -> None:
+        self.busy_begins = [[] for _ in self.operator_names]
+        self.busy_ends = [[] for _ in self.operator_names]
+
+    # Forgets the reservations over before the given time, the clock of the simulation only moves forward
+    def release_before(self, time) -> None:
+        seconds = self._to_seconds(time)
+        for operator_index in range(len(self.operator_names)):
+            position = bisect_right(self.busy_ends[operator_index], seconds)
+            if position:
+                del self.busy_begins[operator_index][:position]
+                del self.busy_ends[operator_index][:position]
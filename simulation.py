@@ -0,0 +1,155 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from assignments_log import AssignmentRecorder
+from compiled_scenario import CACHE_DIRECTORY, load_or_compile
+from metrics import ProductionMetrics
+from common import SHIPMENT_STEP, build_operators, component_arrivals, build_steps, load_config, simulation_period
+from operators_calendar import OperatorsCalendar
+from operators_index import OperatorsIndex
+from simulation_engine import LEGACY_TICK, EventQueue, fill_arrival_events, fill_initial_events, run_event_driven, run_hour_stepping
+from step_log import RETIRE_BATCH
+from TasksHierarchy import ReadinessTracker, fill_initial_inventory, load_inventory
+
+
+# A simulation of the production, built from the configuration (the content of SimulatorInputs.json) and the
+# inventory (the content of inventory.csv). All the state of the run lives on the instance, so that several
+# simulations can coexist in the same process and a simulation can be reset and run again as many times as needed.
+# The operators and their calendar are built once, reset() only rebuilds the logs, the reservations and the assignments.
+# The assignments are streamed to assignments_path (a long format CSV file, or a Parquet dataset) when it is given.
+# With deliveries, the components of ComponentArrivalTimes enter the first steps at their arrival dates during the run,
+# on top of the modules of the inventory (which then only has to describe the state of the production at the start).
+# A compiled scenario (see compiled_scenario) of the same inputs can be given to skip their parsing and compilation.
+# With metrics_resolution (a timedelta), the production metrics (see metrics) are updated as the simulation runs.
+# With history_directory, the logs only keep the modules still in the steps in memory, the rows of the modules that
+# left are moved to one append-only history file per step in that directory (see StepLog.start_history).
+class Simulation:
+
+    def __init__(self, data: dict, inventory: pd.DataFrame, seed=None, assignments_path=None, trace=None,
+                 deliveries: bool = False, compiled=None, metrics_resolution=None, history_directory=None):
+        self.data: dict = data
+        self.inventory: pd.DataFrame = inventory
+        self.simulation_start, self.simulation_end = simulation_period(data)
+        self.compiled = compiled
+
+        if compiled is None:
+            self.operators: list = build_operators(data)
+            self.operators_calendar: OperatorsCalendar = OperatorsCalendar.compile(data, self.simulation_start,
+                                                                                   self.simulation_end)
+            step_names = [step["Step"] for step in data["StagesAndSteps"]]
+            self.operators_index: OperatorsIndex = OperatorsIndex(self.operators_calendar,
+                                                                  [operator.skills for operator in self.operators],
+                                                                  step_names)
+        else:
+            self.operators: list = compiled.operators()
+            self.operators_calendar: OperatorsCalendar = compiled.calendar()
+            self.operators_index: OperatorsIndex = OperatorsIndex(self.operators_calendar, compiled.skills,
+                                                                  compiled.step_names)
+        self.seed = seed
+        self.assignments_path = assignments_path
+        self.trace = trace
+        self.deliveries: bool = deliveries
+        self.metrics_resolution = metrics_resolution
+        self.history_directory = history_directory
+        self.reset()
+
+    @classmethod
+    def from_files(cls, config_path: str = "SimulatorInputs.json", inventory_path: str = "inventory.csv", seed=None,
+                   assignments_path=None):
+        return cls(load_config(config_path), load_inventory(inventory_path), seed, assignments_path)
+
+    # Same as from_files, through the cache of compiled scenarios: the inputs are validated and compiled on the first
+    # use of the files only
+    @classmethod
+    def from_cache(cls, config_path: str = "SimulatorInputs.json", inventory_path: str = "inventory.csv", seed=None,
+                   assignments_path=None, cache_directory: str = CACHE_DIRECTORY):
+        compiled = load_or_compile(config_path, inventory_path, cache_directory)
+        return cls(compiled.data, compiled.inventory, seed, assignments_path, compiled=compiled)
+
+    # Puts the simulation back at simulation_start, with the initial inventory. A new seed can be given for the run.
+    def reset(self, seed=None) -> None:
+        if seed is not None:
+            self.seed = seed
+        self.rng: np.random.RandomState = np.random.RandomState(self.seed)
+
+        if self.compiled is None:
+            self.steps: dict = build_steps(self.data)
+            fill_initial_inventory(self.steps, self.inventory, self.simulation_start)
+        else:
+            self.steps: dict = self.compiled.steps()
+        self.attach_history()
+        self.readiness: ReadinessTracker = ReadinessTracker(self.steps)
+        self.operators_index.clear()
+        self.assignments: AssignmentRecorder = AssignmentRecorder(list(self.steps.keys()),
+                                                                  self.operators_index.operator_names,
+                                                                  self.assignments_path)
+
+        self.time: datetime = self.simulation_start
+        self.events: EventQueue = EventQueue()
+        fill_initial_events(self.events, self.steps)
+        self.arrivals: list = component_arrivals(self.data) if self.deliveries else []
+        self.next_arrival: int = 0  # Index of the next delivery in arrivals
+        fill_arrival_events(self.events, self.arrivals)
+        self.modules_completed: int = len(self.steps[SHIPMENT_STEP].log)
+        self.rebuild_metrics()
+
+    # Bounded memory mode of the logs (nothing without history_directory). The steps without next step keep their
+    # finished modules as a count.
+    def attach_history(self, batch: int = RETIRE_BATCH) -> None:
+        if self.history_directory is None:
+            return
+        os.makedirs(self.history_directory, exist_ok=True)
+        previous_names = {previous_step.name for step in self.steps.values() if step.previous_steps[0] is not None
+                          for previous_step in step.previous_steps}
+        for step_index, step in enumerate(self.steps.values()):
+            step.log.start_history(os.path.join(self.history_directory, f"step_{step_index:03d}.bin"),
+                                   terminal=step.name not in previous_names, batch=batch)
+
+    # Metrics of the current state (None without metrics_resolution), kept up to date by the next runs
+    def rebuild_metrics(self) -> None:
+        self.metrics = None
+        if self.metrics_resolution is not None:
+            self.metrics = ProductionMetrics.from_simulation(self, self.metrics_resolution)
+        self.assignments.observer = self.metrics
+
+    # Optional instrumentation.Trace of the runs, shared with the operators index
+    @property
+    def trace(self):
+        return self.operators_index.trace
+
+    @trace.setter
+    def trace(self, trace) -> None:
+        self.operators_index.trace = trace
+
+    def is_finished(self, modules_to_do: int) -> bool:
+        return self.time >= self.simulation_end or self.modules_completed >= modules_to_do
+
+    # Runs the simulation from its current state until modules_to_do modules are shipped or simulation_end is reached
+    # (or until the clock reaches until). With batch, all the tasks due at the same time are assigned together and run
+    # in parallel (see do_tasks_batch).
+    def run(self, modules_to_do: int, tick=LEGACY_TICK, until=None, batch: bool = False) -> datetime:
+        time = run_event_driven(self, modules_to_do, tick, until, batch)
+        self.assignments.flush()
+        if self.metrics is not None:
+            self.metrics.advance(time)
+        return time
+
+    # Same, with the historical hour stepping loop
+    def run_hour_stepping(self, modules_to_do: int) -> datetime:
+        time = run_hour_stepping(self, modules_to_do)
+        self.assignments.flush()
+        if self.metrics is not None:
+            self.metrics.advance(time)
+        return time
+
+    # Assignments in the historical wide format: one row per assignment time, one column per step
+    @property
+    def operators_assignments(self) -> pd.DataFrame:
+        return self.assignments.to_wide()
+
+    # Logs of the steps in the historical Entry_Date/Exit_Date format
+    def step_logs(self) -> dict:
+        return {name: step.log.to_dataframe() for name, step in self.steps.items()}
@@ -0,0 +1,235 @@
+import heapq
+from datetime import datetime, timedelta
+
+from common import SHIPMENT_STEP
+from instrumentation import phase
+from generate_operators_availability import get_available_operators, get_next_available_time_for_task
+from TasksHierarchy import tasks_by_priority
+from update_log import update_log
+from Operator_assignement import assign_operators, assign_operators_batch
+
+# The historical main loop moved the clock forward by one hour whenever no task could be done. The event driven
+# engine keeps the same grid by default (the clock jumps to the first tick after the next event) so that both loops
+# give exactly the same operators_assignments for a given seed. With tick=None the clock jumps straight to the events.
+LEGACY_TICK: timedelta = timedelta(hours=1)
+
+MODULE_READY: str = "module ready"
+COMPONENT_ARRIVAL: str = "component arrival"
+
+
+# Priority queue of the future events of the simulation, ordered by date. The sequence number keeps the ordering
+# stable for events happening at the same date (and avoids comparing the payloads).
+class EventQueue:
+
+    def __init__(self):
+        self._heap: list = []
+        self._sequence: int = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    # Events in the (time, sequence, kind, payload) format, and the next sequence number, as saved in a checkpoint
+    def state(self) -> tuple:
+        return list(self._heap), self._sequence
+
+    @classmethod
+    def restore(cls, events: list, sequence: int):
+        queue = cls()
+        queue._heap = list(events)
+        heapq.heapify(queue._heap)
+        queue._sequence = sequence
+        return queue
+
+    def push(self, time: datetime, kind: str, payload=None) -> None:
+        heapq.heappush(self._heap, (time, self._sequence, kind, payload))
+        self._sequence += 1
+
+    # Drops all the events that already happened at the given time and returns the date of the next one
+    def next_event_after(self, time: datetime):
+        while self._heap and self._heap[0][0] <= time:
+            heapq.heappop(self._heap)
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+
+# The only thing that can make a task appear in tasks_by_priority without any assignment is a module finishing its
+# duration in a step (it becomes ready for the next step and frees a place in the current one).
+# Shift and holiday boundaries only matter once a task is due, and get_next_available_time_for_task jumps to them.
+def fill_initial_events(queue: EventQueue, Chronologically_Ordered_Steps: dict) -> None:
+    for step in Chronologically_Ordered_Steps.values():
+        for ready_date in step.log.open_ready_dates():
+            queue.push(ready_date, MODULE_READY, step.name)
+
+
+# The deliveries of components wake the simulation up at their dates, the components only enter the logs of the
+# first steps once delivered (see deliver_components)
+def fill_arrival_events(queue: EventQueue, arrivals: list) -> None:
+    for date, step_name, _ in arrivals:
+        queue.push(date, COMPONENT_ARRIVAL, step_name)
+
+
+# Puts the components delivered up to the current time in the first steps, they are ready for the next steps once the
+# duration of the first step is over
+def deliver_components(simulation) -> None:
+    arrivals = simulation.arrivals
+    while simulation.next_arrival < len(arrivals) and arrivals[simulation.next_arrival][0] <= simulation.time:
+        date, step_name, quantity = arrivals[simulation.next_arrival]
+        step = simulation.steps[step_name]
+        for _ in range(quantity):
+            step.log.add(date)
+        simulation.readiness.entered(step, date)
+        simulation.events.push(date + step.duration, MODULE_READY, step_name)
+        simulation.next_arrival += 1
+        if simulation.metrics is not None:
+            simulation.metrics.enter(step_name, date, quantity)
+        if simulation.trace is not None:
+            simulation.trace.count("delivered_components", quantity)
+            simulation.trace.record("arrival", time=date, step=step_name, quantity=quantity)
+
+
+# Tasks that can be done at the current time, in their order of priority (see TasksHierarchy.ReadinessTracker)
+def ready_tasks(simulation) -> list:
+    return simulation.readiness.tasks(simulation.time)
+
+
+def next_clock_value(time: datetime, next_event: datetime, tick) -> datetime:
+    if tick is None:
+        return next_event
+    number_of_ticks: int = -((time - next_event) // tick)  # Ceiling division, we land on the first tick after the event
+    return time + number_of_ticks * tick
+
+
+# Assigns the operators to the tasks one after the other, from the current time of the simulation
+def do_tasks(simulation, to_do: list) -> None:
+    trace = simulation.trace
+    simulation.operators_index.release_before(simulation.time)
+
+    while len(to_do) > 0:
+        task = to_do.pop(0)
+
+        with phase(trace, "next_available_time"):
+            time = get_next_available_time_for_task(simulation.time, task, simulation.operators_index)
+
+        with phase(trace, "available_operators"):
+            operators_available: list = get_available_operators(time, task, simulation.operators, simulation.operators_index)
+
+        if len(operators_available) < 2:
+            print("Err")
+            if trace is not None:
+                trace.count("operators_shortages")
+
+        with phase(trace, "assign_operators"):
+            assign_operators(time, operators_available, task, simulation.assignments,
+                             simulation.operators_calendar, simulation.operators_index, simulation.rng)
+
+        with phase(trace, "update_log"):
+            update_log(task, time, trace, simulation.metrics)
+        simulation.readiness.entered(task, time)
+        simulation.events.push(time + task.duration, MODULE_READY, task.name)
+        if task.name == SHIPMENT_STEP:
+            simulation.modules_completed += 1
+
+        if trace is not None:
+            trace.count("tasks")
+            trace.record("task", time=time, step=task.name, waited=(time - simulation.time).total_seconds())
+
+        simulation.time = time + task.required
+
+
+# Batch mode: all the tasks due at the current time are paired with the free operators at once and run in parallel.
+# The tasks that got no pair wait for the next decision point: the first end of a reservation, the first beginning of
+# a shift, or the next event, whichever comes first.
+def do_tasks_batch(simulation, to_do: list) -> None:
+    trace = simulation.trace
+    time = simulation.time
+    simulation.operators_index.release_before(time)
+
+    with phase(trace, "assign_operators"):
+        assigned: list = assign_operators_batch(time, to_do, simulation.assignments, simulation.operators_calendar,
+                                                simulation.operators_index, simulation.rng)
+
+    for task, is_assigned in zip(to_do, assigned):
+        if not is_assigned:
+            continue
+        with phase(trace, "update_log"):
+            update_log(task, time, trace, simulation.metrics)
+        simulation.readiness.entered(task, time)
+        simulation.events.push(time + task.duration, MODULE_READY, task.name)
+        if task.name == SHIPMENT_STEP:
+            simulation.modules_completed += 1
+        if trace is not None:
+            trace.count("tasks")
+            trace.record("task", time=time, step=task.name, waited=0.0)
+
+    with phase(trace, "next_available_time"):
+        decision_points = [simulation.operators_index.next_release_after(time),
+                           simulation.events.next_event_after(time)]
+        if not all(assigned):  # The waiting tasks can only be done once an operator is released or starts a shift
+            decision_points.append(simulation.operators_calendar.next_opening_after(time))
+        decision_points = [point for point in decision_points if point is not None and point > time]
+    if trace is not None:
+        trace.count("batches")
+        trace.count("waiting_tasks", len(to_do) - sum(assigned))
+
+    simulation.time = min(decision_points) if decision_points else simulation.simulation_end
+
+
+# Same as the historical loop, but the idle periods are skipped in one go. Runs from the current state of the
+# simulation and returns the time at which it stopped. With until, the run pauses as soon as the clock reaches it and
+# can be continued later with the same result as an uninterrupted run. With batch, the tasks are assigned by
+# do_tasks_batch instead of one after the other.
+def run_event_driven(simulation, modules_to_do: int, tick=LEGACY_TICK, until=None, batch: bool = False) -> datetime:
+    trace = simulation.trace
+    while simulation.time < simulation.simulation_end and simulation.modules_completed < modules_to_do \
+            and (until is None or simulation.time < until):
+        if trace is not None:
+            trace.count("iterations")
+
+        deliver_components(simulation)
+        with phase(trace, "ready_tasks"):
+            to_do: list = ready_tasks(simulation)
+
+        if len(to_do) == 0:
+            next_event = simulation.events.next_event_after(simulation.time)
+            if next_event is None:  # Nothing will ever happen again, the simulation runs until the end
+                next_event = simulation.simulation_end
+            next_time = next_clock_value(simulation.time, next_event, tick)
+            if trace is not None:
+                trace.count("idle_jumps")
+                if tick is not None:
+                    trace.count("idle_ticks", (next_time - simulation.time) // tick)
+                trace.record("idle", time=simulation.time, until=next_time)
+            simulation.time = next_time
+            continue
+
+        if batch:
+            do_tasks_batch(simulation, to_do)
+        else:
+            do_tasks(simulation, to_do)
+
+    if trace is not None:
+        trace.record("summary", time=simulation.time, modules_completed=simulation.modules_completed, **trace.summary())
+    return simulation.time
+
+
+# The historical hour stepping loop, kept as a reference for the event driven engine
+def run_hour_stepping(simulation, modules_to_do: int) -> datetime:
+    trace = simulation.trace
+    while simulation.time < simulation.simulation_end and simulation.modules_completed < modules_to_do:
+        if trace is not None:
+            trace.count("iterations")
+
+        deliver_components(simulation)
+        with phase(trace, "tasks_by_priority"):
+            to_do: list = tasks_by_priority(simulation.time, simulation.steps)
+        if len(to_do) == 0:
+            if trace is not None:
+                trace.count("idle_ticks")
+            simulation.time += timedelta(hours=1)
+
+        do_tasks(simulation, to_do)
+
+    if trace is not None:
+        trace.record("summary", time=simulation.time, modules_completed=simulation.modules_completed, **trace.summary())
+    return simulation.time
@@ -0,0 +1,218 @@
+import heapq
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+NAT = np.datetime64("NaT", "ns")
+HISTORY_DTYPE: np.dtype = np.dtype([("entry_date", "datetime64[ns]"), ("exit_date", "datetime64[ns]")])
+RETIRE_BATCH: int = 256  # Number of modules leaving a step between two retirements of the finished rows
+
+
+def to_ns(time) -> int:
+    return int(np.datetime64(time, "ns").astype(np.int64))
+
+
+# Store of the modules that went through a step. The entry and exit dates are kept in preallocated datetime64 arrays
+# (doubled when full), and two heaps split the modules still in the step between:
+#   - the ones still being processed (ordered by the date at which they will be ready),
+#   - the ones ready to be moved to the next step (ordered like the rows of the former log DataFrame).
+# The counters used by tasks_by_priority are then the sizes of those heaps, no scan of the log is needed.
+# The clock of the log only moves forward, queries in the past are answered with a (vectorized) scan.
+#
+# In the bounded memory mode (see start_history), the rows of the modules that left the step are regularly moved out of
+# the arrays to an append-only history file (raw HISTORY_DTYPE records), so that only the modules still in the step stay
+# in memory. The rows are retired by prefix: the indices of the modules do not change, the arrays start at _offset.
+# The last steps (without next step) never see their modules leave, the ready ones are retired as finished and only
+# counted. The queries in the past count them as ready, the simulation never queries a log before its clock.
+# entry_dates and exit_dates still give the whole history, read back from the file.
+class StepLog:
+
+    def __init__(self, duration: timedelta, initial_size: int = 64):
+        self.duration: timedelta = duration
+        self._duration_ns: int = int(np.timedelta64(duration, "ns").astype(np.int64))
+        self._entry_dates: np.ndarray = np.full(initial_size, NAT)
+        self._exit_dates: np.ndarray = np.full(initial_size, NAT)
+        self._size: int = 0
+        self._in_progress: list = []  # Heap of (ready date in ns, index)
+        self._ready: list = []  # Heap of indices
+        self._clock: int = np.iinfo(np.int64).min
+
+        self.history_path = None
+        self.terminal: bool = False
+        self._offset: int = 0  # Index of the first row kept in memory, the rows before are in the history file
+        self._finished: int = 0  # Ready modules of a terminal step retired to the history file
+        self._pending_retire: int = 0
+        self._retire_batch: int = RETIRE_BATCH
+
+    # Rebuilds a log from its dates and the time of its clock (in ns), as saved in a checkpoint
+    @classmethod
+    def restore(cls, duration: timedelta, entry_dates: np.ndarray, exit_dates: np.ndarray, clock: int):
+        log = cls(duration, initial_size=max(len(entry_dates), 1))
+        log._clock = clock
+        for entry_date, exit_date in zip(entry_dates, exit_dates):
+            index = log.add(entry_date)
+            if not np.isnat(exit_date):
+                log._exit_dates[index] = exit_date
+        log._in_progress = [(ready_date, index) for ready_date, index in log._in_progress if np.isnat(log._exit_dates[index])]
+        log._ready = [index for index in log._ready if np.isnat(log._exit_dates[index])]
+        heapq.heapify(log._in_progress)
+        heapq.heapify(log._ready)
+        return log
+
+    def __len__(self) -> int:
+        return self._offset + self._size
+
+    def __repr__(self):
+        return repr(self.to_dataframe())
+
+    def _history(self) -> np.ndarray:
+        if self._offset == 0:
+            return np.empty(0, dtype=HISTORY_DTYPE)
+        return np.fromfile(self.history_path, dtype=HISTORY_DTYPE)
+
+    @property
+    def entry_dates(self) -> np.ndarray:
+        if self._offset == 0:
+            return self._entry_dates[:self._size]
+        return np.concatenate([self._history()["entry_date"], self._entry_dates[:self._size]])
+
+    @property
+    def exit_dates(self) -> np.ndarray:
+        if self._offset == 0:
+            return self._exit_dates[:self._size]
+        return np.concatenate([self._history()["exit_date"], self._exit_dates[:self._size]])
+
+    def entry_date(self, index: int) -> np.datetime64:
+        return self._entry_dates[index - self._offset]
+
+    @property
+    def clock(self) -> int:
+        return self._clock
+
+    # Number of modules that entered the step and have not been moved to the next step yet
+    @property
+    def open_count(self) -> int:
+        return len(self._in_progress) + len(self._ready) + self._finished
+
+    # Starts the bounded memory mode: the finished rows are retired to the history file at the given path (truncated),
+    # every batch modules leaving the step
+    def start_history(self, path: str, terminal: bool = False, batch: int = RETIRE_BATCH) -> None:
+        if self._offset:
+            raise ValueError("The history of the log is already kept in another file")
+        self.history_path, self.terminal, self._retire_batch = path, terminal, batch
+        open(path, "wb").close()
+        self.retire()
+
+    # Moves the longest prefix of rows whose modules left the step (or are finished in a terminal step) to the history
+    # file, and shrinks the arrays to the modules still in the step
+    def retire(self) -> None:
+        self._pending_retire = 0
+        retirable = ~np.isnat(self._exit_dates[:self._size])
+        if self.terminal and self._ready:
+            retirable[np.array(self._ready, dtype=np.int64) - self._offset] = True
+        count = int(np.argmin(retirable)) if not retirable.all() else self._size
+        if count == 0:
+            return
+
+        rows = np.empty(count, dtype=HISTORY_DTYPE)
+        rows["entry_date"], rows["exit_date"] = self._entry_dates[:count], self._exit_dates[:count]
+        with open(self.history_path, "ab") as file:
+            rows.tofile(file)
+
+        if self.terminal:
+            kept = [index for index in self._ready if index >= self._offset + count]
+            self._finished += len(self._ready) - len(kept)
+            self._ready = kept
+            heapq.heapify(self._ready)
+
+        live = self._size - count
+        capacity = max(2 * live, 64)
+        entry_dates, exit_dates = np.full(capacity, NAT), np.full(capacity, NAT)
+        entry_dates[:live], exit_dates[:live] = self._entry_dates[count:self._size], self._exit_dates[count:self._size]
+        self._entry_dates, self._exit_dates = entry_dates, exit_dates
+        self._offset += count
+        self._size = live
+
+    def _grow(self) -> None:
+        new_size = 2 * len(self._entry_dates)
+        self._entry_dates = np.concatenate([self._entry_dates, np.full(new_size - len(self._entry_dates), NAT)])
+        self._exit_dates = np.concatenate([self._exit_dates, np.full(new_size - len(self._exit_dates), NAT)])
+
+    def _retire_if_due(self) -> None:
+        if self.history_path is not None and self._pending_retire >= self._retire_batch:
+            self.retire()
+
+    def add(self, entry_date) -> int:
+        self._retire_if_due()
+        if self.terminal:
+            self._pending_retire += 1
+        if self._size == len(self._entry_dates):
+            self._grow()
+        index = self._offset + self._size
+        self._entry_dates[self._size] = np.datetime64(entry_date, "ns")
+        self._size += 1
+
+        ready_date = to_ns(entry_date) + self._duration_ns
+        if ready_date <= self._clock:
+            heapq.heappush(self._ready, index)
+        else:
+            heapq.heappush(self._in_progress, (ready_date, index))
+        return index
+
+    # Moves the modules whose processing is over at the given time to the ready heap
+    def advance(self, time) -> None:
+        time_ns = to_ns(time)
+        if time_ns < self._clock:
+            return
+        self._clock = time_ns
+        while self._in_progress and self._in_progress[0][0] <= time_ns:
+            _, index = heapq.heappop(self._in_progress)
+            heapq.heappush(self._ready, index)
+
+    # Ready dates of the modules still in the step, apart from the finished ones already retired
+    def _open_ready_dates(self) -> np.ndarray:
+        open_modules = np.isnat(self._exit_dates[:self._size])
+        return self._entry_dates[:self._size][open_modules].astype(np.int64) + self._duration_ns
+
+    # Number of modules being processed in the step at the given time
+    def in_progress(self, time) -> int:
+        time_ns = to_ns(time)
+        if time_ns < self._clock:
+            return int((self._open_ready_dates() > time_ns).sum())
+        self.advance(time)
+        return len(self._in_progress)
+
+    # Number of modules waiting to be moved to the next step at the given time
+    def ready(self, time) -> int:
+        time_ns = to_ns(time)
+        if time_ns < self._clock:
+            return int((self._open_ready_dates() <= time_ns).sum()) + self._finished
+        self.advance(time)
+        return len(self._ready) + self._finished
+
+    # Date at which the next module being processed will be ready, None if there is no such module
+    def next_ready_date(self):
+        if self._in_progress:
+            return pd.Timestamp(self._in_progress[0][0])
+        return None
+
+    # Ready dates of all the modules still in the step, used to seed the events of the simulation
+    def open_ready_dates(self) -> list:
+        return [pd.Timestamp(date) for date in self._open_ready_dates()]
+
+    # Takes the first ready module out of the step and fills its exit date. Returns its index, None if there is none.
+    # In the bounded memory mode, its row is retired with the next batch.
+    def pop_ready(self, time):
+        self._retire_if_due()
+        self.advance(time)
+        if not self._ready:
+            return None
+        index = heapq.heappop(self._ready)
+        self._exit_dates[index - self._offset] = np.datetime64(time, "ns")
+        self._pending_retire += 1
+        return index
+
+    # Export to the historical log format
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({"Entry_Date": self.entry_dates.copy(), "Exit_Date": self.exit_dates.copy()})
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import copy
+import multiprocessing
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import CheckpointStore, inputs_divergence, load_checkpoint
+from common import load_config
+from ensemble import summarize
+from simulation import Simulation
+from TasksHierarchy import load_inventory
+
+# What-if sweeps: variants of a scenario ("what if we add an operator in March", "what if Operator3 is out for a
+# month"...) share the history of the base scenario up to the date of their change. The base scenario is simulated
+# once, paused at the divergence date of each variant to keep a checkpoint, and each variant is forked from that
+# checkpoint (loaded into a simulation built from its own inputs) and only simulates the rest, in a process pool.
+#
+# The base pauses at the first decision of its loop at or after the divergence date (a pause never changes a run, see
+# run_event_driven). When the base has nothing to do at that date, it pauses at its next decision: the change of the
+# variant then applies from that time, never before its date. The table gives it as forked_at.
+
+
+# A variant of the base inputs. since is the date from which the change applies: by default it is the first date at
+# which the inputs differ (see inputs_divergence), but changes that are not dated in the configuration (new operator,
+# new capacity...) would otherwise apply from the start of the simulation.
+@dataclass
+class Variant:
+    name: str
+    data: dict
+    inventory: pd.DataFrame = None
+    since: datetime = None
+
+
+# A new operator with the skills and work hours of an existing one, available from the given date
+def add_operator(data: dict, like: str, since: datetime, name=None) -> Variant:
+    data = copy.deepcopy(data)
+    new_name = f"Operator{len(data['Operators']) + 1}"
+    simulation_start = datetime.fromisoformat(data["SimulationParameters"]["simulation_start"])
+    data["Operators"][new_name] = list(data["Operators"][like])
+    data["OperatorWorkHours"][new_name] = copy.deepcopy(data["OperatorWorkHours"][like])
+    data["OperatorHolidays"][new_name] = [[f"{simulation_start:%Y-%m-%d}", f"{since:%Y-%m-%d}"]]
+    return Variant(name or f"{new_name} like {like} from {since:%Y-%m-%d}", data, since=since)
+
+
+# An operator away from first to last (as days, the last one excluded like the other holidays)
+def operator_absence(data: dict, operator: str, first: datetime, last: datetime, name=None) -> Variant:
+    data = copy.deepcopy(data)
+    data["OperatorHolidays"][operator].append([f"{first:%Y-%m-%d}", f"{last:%Y-%m-%d}"])
+    return Variant(name or f"{operator} out {first:%Y-%m-%d} - {last:%Y-%m-%d}", data)
+
+
+# The capacity of the step multiplied by factor from the given date
+def scale_capacity(data: dict, step_name: str, factor: float, since: datetime, name=None) -> Variant:
+    data = copy.deepcopy(data)
+    for step in data["StagesAndSteps"]:
+        if step["Step"] == step_name:
+            step["Capacity"] = max(1, int(round(step["Capacity"] * factor)))
+    return Variant(name or f"{step_name} capacity x{factor} from {since:%Y-%m-%d}", data, since=since)
+
+
+# Hours spent by the modules waiting, ready, for the next step, per stage of that next step. The stage where the
+# modules wait the most is the bottleneck of the production.
+def stage_waits(simulation: Simulation) -> dict:
+    stage_of = {step["Step"]: step["Stage"] for step in simulation.data["StagesAndSteps"]}
+    end_ns = np.datetime64(simulation.time, "ns")
+    waits = {}
+    for step in simulation.steps.values():
+        if step.previous_steps[0] is None:
+            continue
+        for previous_step in step.previous_steps:
+            log = previous_step.log
+            ready_dates = log.entry_dates + np.timedelta64(log.duration)
+            leave_dates = np.where(np.isnat(log.exit_dates), end_ns, log.exit_dates)
+            wait = np.maximum(leave_dates - ready_dates, np.timedelta64(0, "ns")).sum()
+            waits[stage_of[step.name]] = waits.get(stage_of[step.name], 0.0) + wait / np.timedelta64(1, "h")
+    return waits
+
+
+def compare(summary: dict, simulation: Simulation) -> dict:
+    waits = stage_waits(simulation)
+    bottleneck = max(waits, key=waits.get) if waits else None
+    return {"completion_date": summary["completion_date"], "modules_completed": simulation.modules_completed,
+            "bottleneck_stage": bottleneck, "bottleneck_wait_hours": waits.get(bottleneck, np.nan)}
+
+
+# Runs a variant in a worker process, from the checkpoint of the base (or from the start if there is none)
+def run_variant(arguments: tuple) -> tuple:
+    name, data, inventory, path, modules_to_do, seed, options = arguments
+    simulation = Simulation(data, inventory, seed, **options)
+    if path is not None:
+        load_checkpoint(simulation, path, check_inputs=False)
+    simulation.run(modules_to_do)
+    return name, compare(summarize(simulation, modules_to_do), simulation)
+
+
+# Runs the base simulation to the end, pausing it at each divergence date. Returns for each divergence date the path of
+# the checkpoint of the pause and its time (None and the start for the divergences at the start of the simulation,
+# "base" and None for the ones after the end of the base)
+def run_shared_history(base: Simulation, modules_to_do: int, divergences: list, store: CheckpointStore) -> dict:
+    forks = {}
+    pending = sorted(set(divergences))
+    while pending and pending[0] <= base.time:
+        forks[pending.pop(0)] = (None, base.time)
+
+    while pending and not base.is_finished(modules_to_do):
+        base.run(modules_to_do, until=pending[0])
+        if base.time < pending[0]:  # Finished before the divergence
+            break
+        snapshot = store.save(base)
+        while pending and pending[0] <= base.time:
+            forks[pending.pop(0)] = (snapshot, base.time)
+
+    for divergence in pending:  # The base is over before those changes, the variants are the same as the base
+        forks[divergence] = ("base", None)
+    base.run(modules_to_do)
+    return forks
+
+
+# Simulates the base scenario and its variants, and returns the comparison table: one row per scenario (the base
+# first) with its divergence date, the time it was forked from the base, the date at which the last requested module is
+# shipped, the delay compared to the base and the bottleneck stage.
+# The options of the simulations (see Simulation) are the same for the base and the variants; with history_directory,
+# each scenario keeps its history files in its own subdirectory.
+def sweep(data: dict, inventory: pd.DataFrame, variants: list, modules_to_do: int, seed: int = 0, workers=None,
+          directory=None, deliveries: bool = False, metrics_resolution=None, history_directory=None) -> pd.DataFrame:
+    def options(name: str) -> dict:
+        return {"deliveries": deliveries, "metrics_resolution": metrics_resolution,
+                "history_directory": None if history_directory is None else os.path.join(history_directory, name)}
+
+    divergences = {}
+    for variant in variants:
+        variant_inventory = inventory if variant.inventory is None else variant.inventory
+        divergences[variant.name] = variant.since if variant.since is not None else \
+            inputs_divergence(data, inventory, variant.data, variant_inventory)
+
+    with tempfile.TemporaryDirectory() if directory is None else contextlib.nullcontext(directory) as checkpoints_directory:
+        base = Simulation(data, inventory, seed, **options("base"))
+        forks = run_shared_history(base, modules_to_do, [date for date in divergences.values() if date is not None],
+                                   CheckpointStore(checkpoints_directory))
+        rows = {"base": compare(summarize(base, modules_to_do), base)}
+
+        tasks = []
+        forked_at = {"base": None}
+        for variant_index, variant in enumerate(variants):
+            fork, forked_at[variant.name] = forks.get(divergences[variant.name], ("base", None))
+            if divergences[variant.name] is None or fork == "base":
+                rows[variant.name] = dict(rows["base"])
+            else:
+                tasks.append((variant.name, variant.data, inventory if variant.inventory is None else variant.inventory,
+                              fork, modules_to_do, seed, options(f"variant_{variant_index:03d}")))
+
+        if tasks:
+            with multiprocessing.Pool(processes=min(workers or os.cpu_count(), len(tasks))) as pool:
+                rows.update(dict(pool.imap_unordered(run_variant, tasks)))
+
+    table = pd.DataFrame.from_dict(rows, orient="index").reindex(["base"] + [variant.name for variant in variants])
+    table.insert(0, "divergence", [None] + [divergences[variant.name] for variant in variants])
+    table.insert(1, "forked_at", [forked_at[name] for name in table.index])
+    table.insert(3, "delay_days", (table["completion_date"] - table.loc["base", "completion_date"]) / pd.Timedelta(days=1))
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="What-if sweep of the production simulation")
+    parser.add_argument("modules", type=int, help="Number of modules to simulate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--config", default="SimulatorInputs.json")
+    parser.add_argument("--inventory", default="inventory.csv")
+    parser.add_argument("--add-operator", nargs=2, action="append", default=[], metavar=("LIKE", "SINCE"),
+                        help="New operator with the skills of LIKE, available from the date SINCE")
+    parser.add_argument("--absence", nargs=3, action="append", default=[], metavar=("OPERATOR", "FIRST", "LAST"),
+                        help="OPERATOR away from the date FIRST to the date LAST")
+    parser.add_argument("--capacity", nargs=3, action="append", default=[], metavar=("STEP", "FACTOR", "SINCE"),
+                        help="Capacity of STEP multiplied by FACTOR from the date SINCE")
+    arguments = parser.parse_args()
+
+    data, inventory = load_config(arguments.config), load_inventory(arguments.inventory)
+    variants = [add_operator(data, like, datetime.fromisoformat(since)) for like, since in arguments.add_operator]
+    variants += [operator_absence(data, operator, datetime.fromisoformat(first), datetime.fromisoformat(last))
+                 for operator, first, last in arguments.absence]
+    variants += [scale_capacity(data, step, float(factor), datetime.fromisoformat(since))
+                 for step, factor, since in arguments.capacity]
+
+    table = sweep(data, inventory, variants, arguments.modules, arguments.seed, arguments.workers)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(table)
+
+
+if __name__ == "__main__":
+    main()